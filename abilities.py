@@ -1,11 +1,13 @@
 import pygame
 from locals import *
 from abc import ABC
+from simulation import AbilityState, ABILITY_SPECS
 from spritesheet import SpriteSheet
+from perf import SurfaceCounter
 
 """
     Stores and renders abilities via AbilityBar
-    Implements different abilities
+    Implements different abilities, their movement is described by simulation.ABILITY_SPECS
 
     Classes:
 
@@ -28,70 +30,75 @@ sprite_size = 68
 
 
 class Ability(ABC):
-    """ Renders ability, tracks it CD and executes it """
+    """ Renders ability and its CD, the CD itself is tracked by a simulation.AbilityState """
 
     name = "Void Ability"
     # Coordinates of the upper-left corner of the first frame of animation on the spritesheet
     cordsx = 0
     cordsy = 0
 
-    def __init__(self, move_sequence=None, cd: int = 5):
-        """ Initilizes CD timer, binds ability with the abilitybar
-        :param move_sequence: Move function(moves:list[tuple[int, int]]) -> None
-        :param cd: cooldown of the ability
+    # (ability class, size) -> CD frames shared by every ability of the class shown at that size
+    _frames = {}
+
+    def __init__(self):
+        """ Initilizes the ability with its own, unused CD state """
+        self.state = AbilityState(ABILITY_SPECS[self.name])
+        self.frames = self.get_frames()
+
+    @classmethod
+    def get_frames(cls, size: int = sprite_size) -> list[pygame.Surface]:
+        """ Cuts the CD frames of the class from the spritesheet and scales them once per size
+        :param size: optional, the length of the frame side in pixels, the size on the spritesheet by default
+        :return: Shared frames indexed by the CD, must not be modified
         """
-        self.cd_left = 0
-        self.move_sequence = move_sequence
-        self.key = None
-        self.CD = cd
-        self.frames = spritesheet.load_strip((self.cordsx, self.cordsy, sprite_size, sprite_size), 6, Color.WHITE)
+        key = (cls, int(size))
+        if key not in Ability._frames:
+            if size == sprite_size:
+                Ability._frames[key] = spritesheet.load_strip((cls.cordsx, cls.cordsy, sprite_size, sprite_size),
+                                                              6, Color.WHITE)
+            else:
+                Ability._frames[key] = [pygame.transform.scale(frame, (key[1], key[1])) for frame in cls.get_frames()]
+                SurfaceCounter.add(len(Ability._frames[key]))
+        return Ability._frames[key]
+
+    @property
+    def cd_left(self) -> int:
+        """ :returns: the amount of beats left until the ability is ready """
+        return self.state.cd_left
 
     def render(self) -> pygame.Surface:
         """:return: surface with the ability image rendered on it """
         return self.frames[self.cd_left]
 
-    def update(self) -> None:
-        """ For now abilities have now animation or progression """
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ For now abilities have now animation or progression
+        :param dt: the amount of milliseconds since the previous update
+        """
         pass
 
-    def handle(self, event: pygame.event.Event) -> None:
-        """ Recharges CD and executes ability if ready
-        :param event: Event to be handled"""
-        if self.is_active() and self.key and event.key == self.key:
-            self.execute()
-            self.cd_left = self.CD
-        self.cd_left -= 1
-        self.cd_left = max(self.cd_left, 0)
-
     def is_active(self) -> bool:
         """ :returns: True if cd is over """
-        return self.cd_left <= 0
-
-    def execute(self) -> None:
-        """ Executes the ability """
-        pass
+        return self.state.is_active()
 
 
 class AbilityBar:
-    """ Stores and manages abilities, renders and executes them """
+    """ Stores the abilities of the four slots, bound to keys by controls.Bindings, and renders them with their CDs """
 
-    keys = [pygame.K_h, pygame.K_j, pygame.K_k, pygame.K_l]
     height = int(HEIGHT * 0.8)
     width = int(height * 0.25)
     x, y = int(WIDTH * 0.15), int(height / 2)
 
-    def __init__(self, move_sequence, pos: tuple[int, int] = None):
-        """ Initializes AbilityBar wiht 4 default abilities and binds move function
-        :param move_sequence: Move function(moves:list[tuple[int, int]]) -> None
-        :param pos: ??????????
+    def __init__(self, pos: tuple[int, int] = None):
+        """ Initializes AbilityBar wiht 4 default abilities
+        :param pos: optional, center (x, y) of the bar, its size is derived from it
         """
-        self.move_sequence = move_sequence
         if pos:
             self.x, self.y = pos
             self.height = self.y * 2
             self.width = int(self.height / 4)
         self.abilities = [None] * 4
         self.set_default_abilities()
+        self.drawn_state = None  # (ability class, CD) of every slot as of the last dirty_rects() call
 
     def set_default_abilities(self) -> None:
         """ Fills slots with Knight abilities """
@@ -100,35 +107,53 @@ class AbilityBar:
         self.set_ability(2, KnightUpRight())
         self.set_ability(3, KnightRightUp())
 
-    def copy_abilities(self, ability_bar) -> None:
-        """ Fills slots with abilities from another ability bar """
-        if ability_bar is None:
-            return
-        for i, ability in enumerate(ability_bar.abilities):
-            self.set_ability(i,
-                             ability_list[ability_names.index(ability.name)]())
+    def set_abilities(self, names: list[str]) -> None:
+        """ Fills slots with new abilities
+        :param names: Names of the abilities in slot order, see ability_names
+        """
+        for i, name in enumerate(names):
+            self.set_ability(i, ability_list[ability_names.index(name)]())
+
+    def bind(self, states: list[AbilityState]) -> None:
+        """ Makes abilities display CDs of a running simulation
+        :param states: Ability states, one per slot
+        """
+        for ability, state in zip(self.abilities, states):
+            ability.state = state
 
-    def update(self) -> None:
-        """ Updates animation states of abilities """
+    def names(self) -> list[str]:
+        """ :return: Names of the abilities in slot order """
+        return [ability.name for ability in self.abilities]
+
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ Updates animation states of abilities
+        :param dt: the amount of milliseconds since the previous update
+        """
         for ability in self.abilities:
-            ability.update()
+            ability.update(dt)
 
     def render(self, screen: pygame.Surface) -> None:
-        """ Renders ability sprite
+        """ Renders ability sprites straight onto the screen
         :param screen: PyGame surface to blit onto """
-        surf = pygame.Surface((self.width, self.height + 50), pygame.SRCALPHA)
+        left, top = self.get_rect().topleft
         for place, ability in enumerate(self.abilities):
             aimage = ability.render()
-            arect = aimage.get_rect(center=self.get_pos(place))
-            surf.blit(aimage, arect)
-        screen.blit(surf, surf.get_rect(center=(self.x, self.y + 70)))
-
-    def handle(self, event: pygame.event.Event) -> None:
-        """ Executes abilities when binded keys are pressed """
-        if event.type != pygame.KEYDOWN:
-            return
-        for ability in self.abilities:
-            ability.handle(event)
+            x, y = self.get_pos(place)
+            screen.blit(aimage, aimage.get_rect(center=(left + x, top + y)))
+
+    def get_rect(self) -> pygame.Rect:
+        """ :return: Screen area covered by the ability bar """
+        rect = pygame.Rect(0, 0, self.width, self.height + 50)
+        rect.center = (self.x, self.y + 70)
+        return rect
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :return: List of screen areas which changed since the previous call: the bar if any slot changed """
+        state = tuple((type(ability), ability.cd_left) for ability in self.abilities)
+        if state == self.drawn_state:
+            return []
+        self.drawn_state = state
+        return [self.get_rect()]
 
     def get_pos(self, place: int) -> tuple[int, int]:
         """
@@ -144,12 +169,8 @@ class AbilityBar:
         :param slot: the place of the ability on the ability bar, value between 0 and 3
         :param ability: the ability, created, but not constructed
         """
-        ability.key = self.keys[slot]
-        ability.move_sequence = self.move_sequence
         self.abilities[slot] = ability
-
-        for i, frame in enumerate(ability.frames):
-            ability.frames[i] = pygame.transform.scale(frame, (self.width, self.width))
+        ability.frames = ability.get_frames(self.width)
 
 
 class KnightLeftUp(Ability):
@@ -160,14 +181,6 @@ class KnightLeftUp(Ability):
     cordsx = 0
     cordsy = 3 * sprite_size
 
-    def __init__(self, *args):
-        """ Initilizes the ability"""
-        super().__init__(*args)
-
-    def execute(self) -> None:
-        """ Teleports to the left and top """
-        self.move_sequence((-1, 0), (-1, 0), (0, 1))
-
 
 class KnightUpLeft(Ability):
     """ Represents top-left dash """
@@ -177,14 +190,6 @@ class KnightUpLeft(Ability):
     cordsx = 0
     cordsy = 2 * sprite_size
 
-    def __init__(self, *args):
-        """ Initilizes the ability"""
-        super().__init__(*args)
-
-    def execute(self) -> None:
-        """ Teleports to the left and top """
-        self.move_sequence((0, 1), (0, 1), (-1, 0))
-
 
 class KnightUpRight(Ability):
     """ Represents top-right dash """
@@ -194,14 +199,6 @@ class KnightUpRight(Ability):
     cordsx = 0
     cordsy = sprite_size
 
-    def __init__(self, *args):
-        """ Initilizes the ability"""
-        super().__init__(*args)
-
-    def execute(self) -> None:
-        """ Teleports to the left and top """
-        self.move_sequence((0, 1), (0, 1), (1, 0))
-
 
 class KnightRightUp(Ability):
     """ Represents left-top dash """
@@ -211,14 +208,6 @@ class KnightRightUp(Ability):
     cordsx = 0
     cordsy = 0
 
-    def __init__(self, *args):
-        """ Initilizes the ability"""
-        super().__init__(*args)
-
-    def execute(self) -> None:
-        """ Teleports to the left and top """
-        self.move_sequence((1, 0), (1, 0), (0, 1))
-
 
 class RushUp(Ability):
     """ Represents three-steps-up dash """
@@ -228,14 +217,6 @@ class RushUp(Ability):
     cordsx = 0
     cordsy = 4 * sprite_size
 
-    def __init__(self, *args):
-        """ Initilizes the ability"""
-        super().__init__(*args)
-
-    def execute(self) -> None:
-        """"""
-        self.move_sequence((0, 1), (0, 1), (0, 1))
-
 
 class Hop(Ability):
     """ Represents a teleport two tiles up """
@@ -245,14 +226,6 @@ class Hop(Ability):
     cordsx = 0
     cordsy = 5 * sprite_size
 
-    def __init__(self, *args):
-        """ Initilizes the ability"""
-        super().__init__(*args)
-
-    def execute(self) -> None:
-        """"""
-        self.move_sequence((0, 2))
-
 
 '''
 class Mirror(Ability):
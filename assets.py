@@ -0,0 +1,129 @@
+import os.path
+from collections import OrderedDict
+import pygame
+from locals import FONT_PATH
+from perf import SurfaceCounter
+
+"""
+Process-wide cache of images: every image is loaded from disk, converted to the display format
+and scaled once per (name, size, colorkey), then the same surface is handed out to everyone asking for it.
+Fonts and rendered text are cached the same way, the least recently used ones are evicted past a limit.
+Shared surfaces must be treated as read-only
+
+Classes:
+
+    Assets
+
+Constants:
+
+    IMAGES_DIR
+    MAX_FONTS, MAX_TEXTS
+"""
+
+IMAGES_DIR = os.path.join('resources', 'images')
+MAX_FONTS = 32  # font sizes kept loaded, animated buttons go through about a dozen
+MAX_TEXTS = 256  # rendered texts kept
+
+
+class Assets:
+    """ Singleton cache of loaded, converted and scaled images, fonts and rendered text """
+    _instance = None
+
+    def __init__(self):
+        """ Starts with an empty cache """
+        Assets._instance = self
+        self.originals = {}  # name -> image as loaded from disk
+        self.images = {}  # (name, size, colorkey) -> prepared image
+        self.converted = False  # whether the cached images are in the display format
+        self.fonts = OrderedDict()  # (path, size) -> font, least recently used first
+        self.texts = OrderedDict()  # (text, size, color, path) -> rendered text, least recently used first
+
+    @staticmethod
+    def get_instance():
+        """ :returns: the only instance of the class Assets """
+        if Assets._instance is None:
+            Assets()
+        return Assets._instance
+
+    @staticmethod
+    def convert(image: pygame.Surface) -> pygame.Surface:
+        """ Converts image to the display pixel format, keeping per-pixel alpha if it has any
+        :param image: Surface to convert
+        :return: Converted surface, or the same surface when there is no display yet
+        """
+        if pygame.display.get_surface() is None:
+            return image
+        SurfaceCounter.add()
+        if image.get_flags() & pygame.SRCALPHA:
+            return image.convert_alpha()
+        return image.convert()
+
+    def reset_surfaces(self) -> None:
+        """ Drops the surfaces cached before the display was set up, so they are prepared again in its format """
+        self.originals.clear()
+        self.images.clear()
+        self.texts.clear()
+        self.converted = True
+
+    def image(self, name: str, size: tuple[int, int] = None, colorkey=None) -> pygame.Surface:
+        """
+        :param name: File name of the image inside IMAGES_DIR
+        :param size: optional, size (width, height) to scale the image to
+        :param colorkey: optional, color to be drawn transparent
+        :return: Shared surface with the prepared image
+        """
+        if not self.converted and pygame.display.get_surface() is not None:
+            self.reset_surfaces()
+        key = (name, None if size is None else (int(size[0]), int(size[1])), colorkey)
+        if key not in self.images:
+            if name not in self.originals:
+                self.originals[name] = Assets.convert(pygame.image.load(os.path.join(IMAGES_DIR, name)))
+                SurfaceCounter.add()
+            image = self.originals[name]
+            if key[1] is not None:
+                image = pygame.transform.scale(image, key[1])
+                SurfaceCounter.add()
+            if colorkey is not None:
+                if image is self.originals[name]:
+                    image = image.copy()
+                    SurfaceCounter.add()
+                image.set_colorkey(colorkey)
+            self.images[key] = image
+        return self.images[key]
+
+    def font(self, size: int, path: str = FONT_PATH) -> pygame.font.Font:
+        """
+        :param size: Font size, rounded down
+        :param path: optional, path of the font file, the game font by default
+        :return: Shared font
+        """
+        key = (path, int(size))
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = pygame.font.Font(path, int(size))
+            if len(self.fonts) > MAX_FONTS:
+                self.fonts.popitem(last=False)
+        else:
+            self.fonts.move_to_end(key)
+        return font
+
+    def text(self, text: str, size: int, color: tuple[int, int, int], path: str = FONT_PATH) -> pygame.Surface:
+        """
+        :param text: Text to render
+        :param size: Font size, rounded down
+        :param color: Color of the text
+        :param path: optional, path of the font file, the game font by default
+        :return: Shared surface with the antialiased text
+        """
+        if not self.converted and pygame.display.get_surface() is not None:
+            self.reset_surfaces()
+        key = (text, int(size), color, path)
+        surface = self.texts.get(key)
+        if surface is None:
+            surface = self.texts[key] = Assets.convert(self.font(size, path).render(text, True, color))
+            SurfaceCounter.add()
+            if len(self.texts) > MAX_TEXTS:
+                self.texts.popitem(last=False)
+        else:
+            self.texts.move_to_end(key)
+        return surface
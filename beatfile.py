@@ -0,0 +1,131 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+"""
+Reads beatline files: text files with one beat time in seconds per line, see resources/beatlines.
+Every file is parsed once into an array of milliseconds, which is cached in memory
+and in a binary sidecar next to the text file, so later runs don't parse it at all.
+The sidecar is a fixed header followed by little-endian doubles, it is mapped into memory and read in place
+
+Functions:
+
+    parse_beats(beat_path) -> array
+    sidecar_path(beat_path) -> str
+    read_sidecar(path, stat, digest=None) -> array | memoryview
+    write_sidecar(path, stat, digest, times) -> None
+    load_beats(beat_path) -> array | memoryview
+
+Constants:
+
+    SIDECAR_SUFFIX
+    MAGIC
+    HEADER
+"""
+
+SIDECAR_SUFFIX = '.beats'
+MAGIC = b'BEATS\x00\x00\x01'
+# magic, mtime in ns and size of the text file, sha1 of the text file, padded so the doubles are 8-byte aligned
+HEADER = struct.Struct('<8sqq20s4x')
+
+_loaded = {}  # beat_path -> (mtime in ns, size, times), beatlines parsed during this run
+
+
+def parse_beats(beat_path: str) -> array:
+    """ Parses a beatline text file.
+    Beats earlier than a beat above them are dropped, they could never be reached while playing
+    :param beat_path: Path of the beatline file
+    :return: Sorted beat times in milliseconds, as ints stored in doubles
+    """
+    times = array('d')
+    with open(beat_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                time = int(float(line.strip()) * 1000)
+                if not times or time >= times[-1]:
+                    times.append(time)
+    return times
+
+
+def sidecar_path(beat_path: str) -> str:
+    """
+    :param beat_path: Path of the beatline file
+    :return: Path of its binary cache
+    """
+    return beat_path + SIDECAR_SUFFIX
+
+
+def read_sidecar(path: str, stat: os.stat_result, digest: bytes = None) -> array | memoryview:
+    """ Maps a binary cache into memory if it is still valid
+    :param path: Path of the cache
+    :param stat: Current stat of the beatline file
+    :param digest: optional, sha1 of the beatline file, accepts a cache with outdated mtime but the same content
+    :return: Beat times in milliseconds as a read-only memoryview of doubles backed by the mapping,
+        an array copy on big-endian machines, None if there is no valid cache
+    """
+    try:
+        with open(path, 'rb') as f:
+            length = os.fstat(f.fileno()).st_size
+            if length < HEADER.size or (length - HEADER.size) % 8:
+                return None
+            # the mapping stays valid after the file is closed
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    magic, mtime, size, cached_digest = HEADER.unpack_from(data)
+    if magic != MAGIC or not ((mtime, size) == (stat.st_mtime_ns, stat.st_size) or digest == cached_digest):
+        data.close()
+        return None
+    times = memoryview(data)[HEADER.size:].cast('d')
+    if sys.byteorder != 'little':
+        times = array('d', times.tobytes())
+        times.byteswap()
+    return times
+
+
+def write_sidecar(path: str, stat: os.stat_result, digest: bytes, times: array | memoryview) -> None:
+    """ Writes a binary cache, silently gives up if the directory isn't writable.
+    The cache is written aside and then renamed over the old one, which may still be mapped by a reader
+    :param path: Path of the cache
+    :param stat: Current stat of the beatline file
+    :param digest: sha1 of the beatline file
+    :param times: Beat times in milliseconds
+    """
+    body = array('d', times)
+    if sys.byteorder != 'little':
+        body.byteswap()
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, stat.st_mtime_ns, stat.st_size, digest))
+            f.write(body.tobytes())
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+
+
+def load_beats(beat_path: str) -> array | memoryview:
+    """ Loads a beatline file, parsing it only if neither memory nor the sidecar holds an up-to-date copy.
+    A sidecar with an outdated mtime is still used if the content hash matches, and its header is refreshed
+    :param beat_path: Path of the beatline file
+    :return: Beat times in milliseconds, an array or a memoryview of doubles shared between callers,
+        must not be modified
+    """
+    stat = os.stat(beat_path)
+    loaded = _loaded.get(beat_path)
+    if loaded is not None and loaded[:2] == (stat.st_mtime_ns, stat.st_size):
+        return loaded[2]
+
+    path = sidecar_path(beat_path)
+    times = read_sidecar(path, stat)
+    if times is None:
+        with open(beat_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).digest()
+        times = read_sidecar(path, stat, digest)
+        if times is None:
+            times = parse_beats(beat_path)
+        write_sidecar(path, stat, digest, times)
+    _loaded[beat_path] = (stat.st_mtime_ns, stat.st_size, times)
+    return times
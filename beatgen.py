@@ -0,0 +1,212 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from locals import MUSIC
+
+"""
+Generates beatline files (see beatfile.py) from the tracks in MUSIC_DIR.
+Onsets are found by spectral flux, the tempo by autocorrelation of the onset envelope,
+then beats are tracked by dynamic programming, trading onset strength against keeping that tempo.
+Tracks are analysed in a process pool, results are indexed by the sha1 of the audio in INDEX_NAME,
+so unchanged tracks are skipped and hand-made beatlines are only replaced when asked to
+
+Functions:
+
+    decode(audio_path) -> np.ndarray
+    onset_envelope(samples) -> np.ndarray
+    estimate_period(envelope) -> float
+    track_beats(envelope, period) -> np.ndarray
+    detect_beats(audio_path) -> list[float]
+    generate_track(title) -> dict
+    generate(titles, workers=None, force=False, overwrite=False) -> dict
+
+Constants:
+
+    MUSIC_DIR, BEATLINES_DIR
+    INDEX_NAME
+    SAMPLE_RATE, WINDOW, HOP
+    MIN_BPM, MAX_BPM, PRIOR_BPM
+    REFINE_PERIODS, TIGHTNESS
+"""
+
+MUSIC_DIR = os.path.join('resources', 'music')
+BEATLINES_DIR = os.path.join('resources', 'beatlines')
+INDEX_NAME = 'generated.json'  # sha1 of the audio behind every generated beatline
+
+SAMPLE_RATE = 22050  # tracks are decoded to mono at this rate
+WINDOW = 1024  # samples per spectrum
+HOP = 512  # samples between spectra, about 23 milliseconds
+
+MIN_BPM, MAX_BPM = 80, 200  # range of tempos searched, slower tracks are played at double tempo
+PRIOR_BPM = 120  # tempos are weighted by a log-normal prior around this one, against picking half or double tempo
+REFINE_PERIODS = 8  # the period is measured over this many beats
+TIGHTNESS = 400  # penalty for beat intervals straying from the period, higher keeps the tempo stricter
+
+
+def decode(audio_path: str) -> np.ndarray:
+    """ Decodes a track with the pygame mixer, which doesn't need an audio device in a worker process
+    :param audio_path: Path of an audio file pygame can load
+    :return: Mono samples at SAMPLE_RATE as floats in [-1, 1]
+    """
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    import pygame
+    pygame.mixer.init(frequency=SAMPLE_RATE, size=-16, channels=1)
+    samples = pygame.sndarray.array(pygame.mixer.Sound(audio_path)).astype(np.float32) / 32768
+    pygame.mixer.quit()
+    return samples if samples.ndim == 1 else samples.mean(axis=1)
+
+
+def onset_envelope(samples: np.ndarray) -> np.ndarray:
+    """ Computes the spectral flux: the summed increase of log magnitudes between consecutive spectra
+    :param samples: Mono samples at SAMPLE_RATE
+    :return: Onset strength for every HOP samples, zero mean and unit deviation.
+        Value i belongs to the window starting at sample i * HOP
+    """
+    frames = 1 + max(len(samples) - WINDOW, 0) // HOP
+    samples = np.pad(samples, (0, max(WINDOW - len(samples), 0)))
+    windows = np.lib.stride_tricks.sliding_window_view(samples, WINDOW)[::HOP][:frames]
+    spectra = np.log1p(100 * np.abs(np.fft.rfft(windows * np.hanning(WINDOW), axis=1)))
+    # kicks and bass mark the beat more reliably than hi-hats, higher frequencies count less
+    weights = 1 / (1 + np.fft.rfftfreq(WINDOW, 1 / SAMPLE_RATE) / 500)
+    flux = (np.maximum(np.diff(spectra, axis=0, prepend=spectra[:1]), 0) * weights).sum(axis=1)
+    # removes the slowly changing loudness, so quiet and loud parts produce comparable peaks
+    kernel = np.ones(int(SAMPLE_RATE / HOP)) / int(SAMPLE_RATE / HOP)
+    flux = np.maximum(flux - np.convolve(flux, kernel, mode='same'), 0)
+    return (flux - flux.mean()) / (flux.std() or 1)
+
+
+def estimate_period(envelope: np.ndarray) -> float:
+    """ Finds the tempo as the strongest autocorrelation lag within MIN_BPM and MAX_BPM,
+    every lag is backed by its double, so the tempo of the bar doesn't win over the tempo of the beat
+    :param envelope: Onset envelope, see onset_envelope
+    :return: Beat period in envelope frames, refined below a frame by parabolic interpolation
+    """
+    rate = SAMPLE_RATE / HOP
+    size = 1 << int(np.ceil(np.log2(2 * len(envelope))))
+    spectrum = np.fft.rfft(envelope, size)
+    correlation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(envelope)]
+    # a period between two frames splits its peak over both of them
+    correlation = np.convolve(correlation, [0.25, 0.5, 0.25], mode='same')
+    lags = np.arange(int(rate * 60 / MAX_BPM), int(rate * 60 / MIN_BPM) + 1)
+    prior = np.exp(-0.5 * np.log2(rate * 60 / lags / PRIOR_BPM) ** 2)
+    best = lags[np.argmax((correlation[lags] + 0.5 * correlation[2 * lags]) * prior)]
+    # the peak at several periods is as wide as the one at a single period, measuring it there is more precise
+    multiple = max(min(REFINE_PERIODS, (len(envelope) - 2) // (best + 1)), 1)
+    around = np.arange(multiple * (best - 1), multiple * (best + 1) + 1)
+    peak = around[np.argmax(correlation[around])]
+    left, center, right = correlation[peak - 1:peak + 2]
+    curvature = left - 2 * center + right
+    return (peak + (0.5 * (left - right) / curvature if curvature < 0 else 0)) / multiple
+
+
+def track_beats(envelope: np.ndarray, period: float) -> np.ndarray:
+    """ Finds the beats maximising their onset strength minus TIGHTNESS times the squared log ratio
+    of every beat interval to the period, see D. Ellis, Beat Tracking by Dynamic Programming
+    :param envelope: Onset envelope, see onset_envelope
+    :param period: Beat period in envelope frames
+    :return: Beat positions in envelope frames
+    """
+    intervals = np.arange(int(period / 2), int(2 * period) + 1)
+    penalty = TIGHTNESS * np.log(intervals / period) ** 2
+    score = envelope.astype(float)
+    previous = np.full(len(envelope), -1)
+    for frame in range(intervals[0], len(envelope)):
+        candidates = frame - intervals[intervals <= frame]
+        gains = score[candidates] - penalty[:len(candidates)]
+        best = int(np.argmax(gains))
+        if gains[best] > 0:
+            score[frame] += gains[best]
+            previous[frame] = candidates[best]
+
+    # the last beat is the best one within the last period, then the chain is followed back
+    tail = len(envelope) - int(period)
+    frame = tail + int(np.argmax(score[tail:]))
+    beats = [frame]
+    while previous[frame] >= 0:
+        frame = previous[frame]
+        beats.append(frame)
+    return np.array(beats[::-1], dtype=float)
+
+
+def detect_beats(audio_path: str) -> list[float]:
+    """
+    :param audio_path: Path of an audio file
+    :return: Beat times in seconds
+    """
+    envelope = onset_envelope(decode(audio_path))
+    beats = track_beats(envelope, estimate_period(envelope))
+    # a beat is placed at the center of its window
+    return list((beats * HOP + WINDOW / 2) / SAMPLE_RATE)
+
+
+def generate_track(title: str) -> dict:
+    """ Detects the beats of a track
+    :param title: Title of the track, see MUSIC.TITLES
+    :return: dict with the beat times in seconds and the tempo in beats per minute
+    """
+    beats = detect_beats(os.path.join(MUSIC_DIR, title + '.mp3'))
+    bpm = 60 * (len(beats) - 1) / (beats[-1] - beats[0]) if len(beats) > 1 else 0
+    return {"beats": beats, "bpm": round(bpm, 1)}
+
+
+def generate(titles: list[str], workers: int = None, force: bool = False, overwrite: bool = False) -> dict:
+    """ Writes beatline files for the tracks whose audio changed since they were generated
+    :param titles: Titles of the tracks, see MUSIC.TITLES
+    :param workers: The amount of worker processes, all cores by default
+    :param force: Generate tracks even if their audio didn't change
+    :param overwrite: Replace beatlines that weren't generated by this tool
+    :return: dict mapping titles to their status: "generated", "unchanged", "hand-made" or "no audio"
+    """
+    index_path = os.path.join(BEATLINES_DIR, INDEX_NAME)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    status = {}
+    stale = {}
+    for title in titles:
+        audio_path = os.path.join(MUSIC_DIR, title + '.mp3')
+        beat_path = os.path.join(BEATLINES_DIR, title + '.txt')
+        if not os.path.exists(audio_path):
+            status[title] = "no audio"
+            continue
+        with open(audio_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        if os.path.exists(beat_path) and title not in index and not overwrite:
+            status[title] = "hand-made"
+        elif os.path.exists(beat_path) and index.get(title, {}).get("sha1") == digest and not force:
+            status[title] = "unchanged"
+        else:
+            stale[title] = digest
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for (title, digest), result in zip(stale.items(), pool.map(generate_track, stale)):
+                with open(os.path.join(BEATLINES_DIR, title + '.txt'), 'w') as f:
+                    f.writelines(f"{time:g}\n" for time in result["beats"])
+                index[title] = {"sha1": digest, "bpm": result["bpm"], "beats": len(result["beats"])}
+                status[title] = "generated"
+        with open(index_path, 'w') as f:
+            json.dump(dict(sorted(index.items())), f, indent=1)
+    return {title: status[title] for title in titles}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates beatlines from the audio of the tracks")
+    parser.add_argument("titles", nargs="*", default=MUSIC.TITLES, help="track titles, all tracks by default")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, all cores by default")
+    parser.add_argument("--force", action="store_true", help="regenerate tracks whose audio didn't change")
+    parser.add_argument("--overwrite", action="store_true", help="replace hand-made beatlines too")
+    args = parser.parse_args()
+    unknown = [title for title in args.titles if title not in MUSIC.TITLES]
+    if unknown:
+        parser.error(f"unknown tracks: {', '.join(unknown)}")
+
+    for title, state in generate(args.titles, args.workers, args.force, args.overwrite).items():
+        print(f"{title:>25}: {state}")
@@ -1,66 +1,196 @@
 import pygame
 import os.path
+import time
+from bisect import bisect_left, bisect_right
+from assets import Assets
+from beatfile import load_beats
+from locals import AUDIO_LATENCY, FPS, FRAME_TIME, Color
 
 """
     Is responisble for beatline.
-    Unpacks beats from premade files and animates them
+    Unpacks beats from premade files (parsed once, see beatfile.py) and animates them
     Checks when you are hitting beats
 
     Classes:
 
+        Clock, FrameClock, AudioClock
         Line, DrawableLine
-        Beat, DrawableBeat
+        TimingStats
 """
 
 
+class Clock:
+    """ Wall-clock time source of a Line """
+
+    def __init__(self):
+        """ Starts counting from zero """
+        self.birthtime = pygame.time.get_ticks()
+
+    def tick(self) -> None:
+        """ Called by the Line once per frame, real time advances by itself """
+        pass
+
+    def time(self) -> int:
+        """ :return: the amount of milliseconds since the clock was created """
+        return pygame.time.get_ticks() - self.birthtime
+
+    def event_time(self, at: float) -> float:
+        """
+        :param at: the time.perf_counter() value at which an event happened
+        :return: the time of the clock at that moment
+        """
+        return self.time() - (time.perf_counter() - at) * 1000
+
+
+class FrameClock(Clock):
+    """ Deterministic time source advancing by a fixed amount every frame,
+    so the same frames always see the same beats regardless of how long they took """
+
+    def __init__(self, frame_time: float = 1000 / FPS):
+        """
+        :param frame_time: the amount of milliseconds each frame advances the clock by
+        """
+        super().__init__()
+        self.frame_time = frame_time
+        self.now = 0
+
+    def tick(self) -> None:
+        """ Advances the clock by a frame """
+        self.now += self.frame_time
+
+    def time(self) -> int:
+        """ :return: the amount of milliseconds of frames ticked so far """
+        return int(self.now)
+
+    def event_time(self, at: float) -> float:
+        """ Events are timed by frames too, so they are judged the same however long the frames took
+        :param at: the time.perf_counter() value at which an event happened, ignored
+        :return: the time of the clock at the last tick
+        """
+        return self.time()
+
+
+class AudioClock(Clock):
+    """ Time source following the playback position of pygame.mixer.music, so beats stay on the music
+    however late it started or however long the frames take.
+    The mixer only reports its position once per audio buffer, between the reports the time is extrapolated
+    with time.perf_counter and every report slews the extrapolation towards it.
+    Falls back to the wall clock while no music is playing """
+
+    CORRECTION = 0.1  # share of the drift removed on every position report
+    RESYNC = 100  # drift in milliseconds after which the clock jumps to the reported position instead of slewing
+    MAX_EXTRAPOLATION = 100  # milliseconds the clock may run ahead of a position the mixer stopped reporting past
+
+    def __init__(self, latency: int = AUDIO_LATENCY):
+        """
+        :param latency: the amount of milliseconds between the mixer reporting a position and it being heard
+        """
+        super().__init__()
+        self.latency = latency
+        self.position = 0  # estimated playback position in milliseconds at the moment self.at
+        self.at = time.perf_counter()
+        self.reported = None  # the last position reported by the mixer, None if the music isn't playing
+        self.now = 0
+
+    @staticmethod
+    def music_position() -> int:
+        """ :return: the playback position reported by the mixer in milliseconds, -1 if no music is playing """
+        try:
+            return pygame.mixer.music.get_pos()
+        except pygame.error:
+            return -1
+
+    def tick(self) -> None:
+        """ Extrapolates the playback position to now and corrects it by the latest mixer report """
+        at = time.perf_counter()
+        position = self.position + (at - self.at) * 1000
+        reported = AudioClock.music_position()
+        if reported < 0:
+            self.reported = None
+        elif reported != self.reported:
+            drift = reported - position
+            if self.reported is None or abs(drift) > AudioClock.RESYNC:
+                position = reported
+            else:
+                position += drift * AudioClock.CORRECTION
+            self.reported = reported
+        else:
+            # the mixer is stalled, don't run away from the music
+            position = min(position, reported + AudioClock.MAX_EXTRAPOLATION)
+        self.position, self.at = position, at
+        self.now = max(self.now, int(position) - self.latency)
+
+    def time(self) -> int:
+        """ :return: the playback position of the music heard at the last tick, never going backwards """
+        return self.now
+
+    def event_time(self, at: float) -> float:
+        """
+        :param at: the time.perf_counter() value at which an event happened
+        :return: the playback position heard at that moment, extrapolated from the last tick
+        """
+        return self.position - self.latency + (at - self.at) * 1000
+
+
 class Line:
     """
     Class containing the data of the music line
-    Handles unpacking of new beats from a file, and cheking whether any beats are active
+    Beats are kept as parallel arrays: the shared beat times and a per-line flag of used beats,
+    the beats on the line are the index window [first, next_index).
+    Every query is a bisect inside the window, so the cost of a frame doesn't grow with the beat density
     """
 
-    def __init__(self, pos: tuple[int, int], width: int, file_path: str, timeloop: int):
+    TIMEFRAME = 200  # the amount of milliseconds each beat stays active for
+
+    def __init__(self, pos: tuple[int, int], width: int, file_path: str, timeloop: int, clock: Clock = None):
         """
         :param pos: the position (x, y) of the center of the line
         :param width: the width of the line
         :param file_path: the path of the file that the line will extract beat data from
         :param timeloop: the amount of milliseconds the beats will be visible on the line
+        :param clock: optional, time source of the line, wall-clock Clock by default
         """
-        self.birthtime = pygame.time.get_ticks()
+        self.clock = clock if clock is not None else Clock()
         self.time = 0
         self.file_path = file_path
         self.timeloop = timeloop
         self.pos = pos
         self.width = width
+        self.step = width / timeloop  # the amount of pixels a beat travels in 1 millisecond
 
         # extracting beats for the first time interval
-        self.beats = []
+        self.times = load_beats(file_path)  # all beat times of the file in milliseconds, sorted
+        self.used = bytearray(len(self.times))  # 1 for the beats which were used to perform an action
+        self.first = 0  # index of the oldest beat still on the line
+        self.next_index = 0  # index of the first beat which hasn't been unpacked yet
         self.last_update = -100000
         self.unpack(0, 2 * timeloop)
 
-    def update(self) -> None:
+    def __len__(self) -> int:
+        """ :return: the amount of beats on the line """
+        return self.next_index - self.first
+
+    def update(self, dt: float = FRAME_TIME) -> None:
         """
-        updates self.time,
-        unpacks extra beats once in self.timeloop
-        kills beats that have finished their lifespan and updates the live ones
-        :return: True is an active beat has been deleted for reaching the end of the line, False in not.
+        updates self.time and unpacks extra beats once in self.timeloop,
+        beat positions are derived from the time when rendering
+        :param dt: the amount of milliseconds since the previous update, unused, beats follow the clock of the line
         """
         # update time
-        self.time = pygame.time.get_ticks() - self.birthtime
+        self.clock.tick()
+        self.time = self.clock.time()
 
         # unpack beats for the next loop
         if self.time - self.last_update >= 0.9 * self.timeloop:
             self.unpack(self.time + self.timeloop, self.time + 2 * self.timeloop)
 
-        # updates the beats
-        for beat in self.beats:
-            beat.update()
-
-    def cleanup(self) -> bool:
-        """cleans up beats that have reached the end of the beatline
-        :return: True if deleted an unused beat"""
-        if self.beats and self.beats[0].time - self.time <= -int(self.timeloop / 2):
-            return self.beats.pop(0).active
+    def cleanup(self) -> list[int]:
+        """cleans up all beats that have reached the end of the beatline, however many frames were missed
+        :return: indices of the deleted beats which were never used"""
+        end = bisect_right(self.times, self.time - int(self.timeloop / 2), self.first, self.next_index)
+        missed = [index for index in range(self.first, end) if not self.used[index]]
+        self.first = end
+        return missed
 
     def handle(self, event: pygame.event.Event) -> None:
         """ Placeholder function """
@@ -68,66 +198,114 @@ class Line:
 
     def unpack(self, start_time: int, end_time: int) -> None:
         """
-        unpacks beats from the self.filepath file
+        puts beats of the window onto the line, every beat is unpacked at most once.
+        Beats before the window which were skipped by a lag spike are put on the line too, to be cleaned up as missed
         :param start_time: the first millisecond from which the beats will be unpacked
         :param end_time: the last millisecond to which the beats will be unpacked
         """
-        with open(self.file_path, 'r') as f:
-            dump = f.readlines()
-            for time in dump:
-                time = int(float(time.strip()) * 1000)
-                if time >= max(start_time, self.last_update + 2000):
-                    if time >= end_time:
-                        break
-                    self.beats.append(DrawableBeat(self, int(time), 200))
+        self.next_index = max(self.next_index, bisect_left(self.times, end_time, self.next_index))
         self.last_update = self.time
 
-    def is_active(self) -> bool:
-        """ :returns: True if any beat is active """
-        for beat in self.beats:
-            if beat.is_active():
-                return True
-        return False
+    def active_range(self) -> range:
+        """ :returns: indices of the beats close enough to the pointer to be hit, used ones included """
+        start = bisect_right(self.times, self.time - Line.TIMEFRAME / 2, self.first, self.next_index)
+        end = bisect_left(self.times, self.time + Line.TIMEFRAME / 2, start, self.next_index)
+        return range(start, end)
+
+    def judge(self, at: float = None):
+        """ Finds the unused beat nearest to the moment of an event
+        :param at: optional, the time.perf_counter() value at which the event happened, the current time by default
+        :return: pair (index of the beat, signed offset in milliseconds, positive if late),
+            None if no unused beat is within TIMEFRAME / 2
+        """
+        moment = self.time if at is None else self.clock.event_time(at)
+        half = Line.TIMEFRAME / 2
+        after = bisect_left(self.times, moment, self.first, self.next_index)
+        before = after - 1
+        # beats may be closer together than TIMEFRAME, so used ones are skipped on both sides
+        while before >= self.first and self.used[before] and moment - self.times[before] < half:
+            before -= 1
+        while after < self.next_index and self.used[after] and self.times[after] - moment < half:
+            after += 1
+        candidates = [index for index in (before, after) if self.first <= index < self.next_index
+                      and not self.used[index] and abs(moment - self.times[index]) < half]
+        if not candidates:
+            return None
+        index = min(candidates, key=lambda i: abs(moment - self.times[i]))
+        return index, moment - self.times[index]
+
+    def use(self, index: int) -> None:
+        """ Marks a beat as used to perform an action
+        :param index: index of the beat
+        """
+        self.used[index] = 1
 
-    def deactivate(self) -> None:
-        """prevents any active beats from being active in the future"""
-        for beat in self.beats:
-            if beat.is_active():
-                beat.deactivate()
+    def active_index(self):
+        """ :returns: index of the first active beat, None if there are none """
+        for index in self.active_range():
+            if not self.used[index]:
+                return index
+        return None
 
 
 class DrawableLine(Line):
     """ Class extending Line by adding visual representation """
     image: pygame.Surface
     pointer_image: pygame.Surface
+    beat_image: pygame.Surface
+    active_image: pygame.Surface
+    background_image: pygame.Surface
 
-    def initiate_images(self, size: tuple[int, int], pointer_size: tuple[int, int] = (6, 40)) -> None:
+    def initiate_images(self, size: tuple[int, int], pointer_size: tuple[int, int] = (6, 40),
+                        beat_size: tuple[int, int] = (10, 40)) -> None:
         """
-        unpacks images from files, resizes them to parameters
+        takes shared images of the given sizes from the asset cache
         :param size: the size(width, height) of the line
         :param pointer_size: the size(width, height) of the pointer
+        :param beat_size: the size(width, height) of a beat
         """
-        self.image = pygame.image.load(os.path.join('resources', 'images', 'BeatLine.png'))
-        self.image.set_colorkey((255, 255, 255))
-        self.image = pygame.transform.scale(self.image, size)
-
-        self.pointer_image = pygame.image.load(os.path.join('resources', 'images', 'BeatLinePointer.png'))
-        self.pointer_image.set_colorkey((255, 255, 255))
-        self.pointer_image = pygame.transform.scale(self.pointer_image, pointer_size)
-
-    def __init__(self, pos: tuple[int, int], width: int, filename: str, timeloop: int):
+        assets = Assets.get_instance()
+        self.image = assets.image('BeatLine.png', size, Color.WHITE)
+        self.pointer_image = assets.image('BeatLinePointer.png', pointer_size, Color.WHITE)
+        self.beat_image = assets.image('Beat.png', beat_size, Color.WHITE)
+        self.active_image = assets.image('BeatActive.png', beat_size, Color.WHITE)
+        self.background_image = assets.image('BeatActiveBackground.png',
+                                             (int(self.step * Line.TIMEFRAME), beat_size[1]), Color.WHITE)
+
+    def __init__(self, pos: tuple[int, int], width: int, filename: str, timeloop: int, clock: Clock = None):
         """
         passes the arguments to the Line initiation, setups images and rectangles for visualisation
         :param pos: the position (x,y) of the center of the line
         :param width: the width of the line
         :param filename: the name of the file that the line will extract beat data from
         :param timeloop: the amount of frames the beats will be visible on the line
+        :param clock: optional, time source of the line, wall-clock Clock by default
         """
-        super().__init__(pos, width, filename, timeloop)
+        super().__init__(pos, width, filename, timeloop, clock)
         self.initiate_images((int(width), int(width / 26)))
         self.rect = self.image.get_rect()
         self.pointer_rect = self.pointer_image.get_rect()
 
+    def get_rect(self) -> pygame.Rect:
+        """ :return: Screen area covered by the line, the pointer and all visible beats """
+        beat_width = int(self.width / self.timeloop * Line.TIMEFRAME) + 10  # the active background is the widest
+        rect = pygame.Rect(0, 0, int(self.width) + beat_width,
+                           max(self.rect.height, self.pointer_rect.height, 40))
+        rect.center = self.pos
+        return rect
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :return: List of screen areas which change from frame to frame """
+        return [self.get_rect()]
+
+    def positions(self, end: int) -> list[int]:
+        """
+        :param end: index right after the last beat to position
+        :return: x coordinates of the beats on the line up to end, computed in one pass
+        """
+        x, step, time = self.pos[0], self.step, self.time
+        return [x + int(step * (beat_time - time)) for beat_time in self.times[self.first:end]]
+
     def render(self, screen: pygame.Surface) -> None:
         """
         Blits line, beats and pointer images
@@ -136,91 +314,70 @@ class DrawableLine(Line):
         self.rect.center = self.pos
         self.pointer_rect.center = self.pos
         screen.blit(self.image, self.rect)
-        for beat in self.beats:
-            if beat.time <= self.time + self.timeloop / 2:
-                beat.render(screen)
-        screen.blit(self.pointer_image, self.pointer_rect)
-
-
-class Beat:
-    """A singular beat on a line"""
-
-    def __init__(self, line, time, timeframe):
-        """
-        :param line: parent BeatLine of the beat
-        :param time: the amount of milliseconds this beat should become centered after, from the start of the song
-        :param timeframe: the amount of milliseconds this beat will be active for
-        """
-        self.line = line
-        self.step = line.width / line.timeloop  # the amount of pixels the beat should travel in 1 sec, type float
-        self.time = time
-        self.timeframe = timeframe
-        self.x = self.line.pos[0] + int(self.step * (self.time - self.line.time))
-        self.y = self.line.pos[1]
-        self.active = True  # whether the beat can be used to perform an action (beat.deactivate sets this to false)
 
-    def is_active(self) -> bool:
-        """
-        checks whether the beat is active by comparing the time difference between it and the BeatLine to the timeframe
-        :return: bool
-        """
-        return self.active and abs(self.time - self.line.time) < self.timeframe / 2
+        y = self.pos[1]
+        active = self.active_range()
+        end = bisect_right(self.times, self.time + self.timeloop / 2, self.first, self.next_index)
+        for index, x in enumerate(self.positions(end), self.first):
+            screen.blit(self.background_image, self.background_image.get_rect(center=(x, y)))
+            image = self.active_image if index in active and not self.used[index] else self.beat_image
+            screen.blit(image, image.get_rect(center=(x, y)))
+        screen.blit(self.pointer_image, self.pointer_rect)
 
-    def deactivate(self) -> None:
-        """prevents the beat from being active in the future"""
-        self.active = False
 
-    def update(self) -> None:
-        """
-        updates the position of the beat
-        """
-        self.x = self.line.pos[0] + int(self.step * (self.time - self.line.time))
+class TimingStats:
+    """ Signed timing offsets of the hits of a session, negative ones are early.
+    Shows players how far off the music they play, a steady mean offset means AUDIO_LATENCY needs adjusting """
 
+    BIN = 20  # width of a histogram bin in milliseconds
 
-class DrawableBeat(Beat):
-    """ Class extending Beat functionality by adding visual representation """
+    def __init__(self):
+        """ Starts with no hits """
+        self.offsets = []
 
-    image: pygame.Surface
-    active_image: pygame.Surface
-    background_image: pygame.Surface
+    def __len__(self) -> int:
+        """ :return: the amount of judged hits """
+        return len(self.offsets)
 
-    def initiate_images(self, size: tuple[int, int] = (10, 40)) -> None:
+    def add(self, offset: float) -> None:
         """
-        unpacks&resizes images from files
-        :param size: size(width, height) of the beat
+        :param offset: signed offset of a hit in milliseconds, see Line.judge
         """
-        self.image = pygame.image.load(os.path.join('resources', 'images', 'Beat.png'))
-        self.image = pygame.transform.scale(self.image, size)
-        self.image.set_colorkey((255, 255, 255))
-
-        self.active_image = pygame.image.load(os.path.join('resources', 'images', 'BeatActive.png'))
-        self.active_image = pygame.transform.scale(self.active_image, size)
-        self.active_image.set_colorkey((255, 255, 255))
-
-        self.background_image = pygame.image.load(os.path.join('resources', 'images', 'BeatActiveBackground.png'))
-        self.background_image = pygame.transform.scale(self.background_image,
-                                                       (int(self.step * self.timeframe), size[1]))
-        self.background_image.set_colorkey((255, 255, 255))
-
-    def __init__(self, line, time, timeframe, size=(10, 40)):
-        super().__init__(line, time, timeframe)
-        self.initiate_images(size)
-        self.rect = self.image.get_rect()
-        self.active_rect = self.active_image.get_rect()
-        self.background_rect = self.background_image.get_rect()
-
-    def render(self, screen: pygame.Surface) -> None:
-        """ Draws beat with animation
-        :param screen: PyGame surface to blit onto 
-        """
-        self.rect.center = (self.x, self.y)
-        self.active_rect.center = (self.x, self.y)
-        self.background_rect.center = (self.x, self.y)
-        screen.blit(self.background_image, self.background_rect)
-        if self.is_active():
-            screen.blit(self.active_image, self.active_rect)
-        else:
-            screen.blit(self.image, self.rect)
+        self.offsets.append(offset)
+
+    def mean(self) -> float:
+        """ :return: the average offset in milliseconds, 0 without hits """
+        return sum(self.offsets) / len(self.offsets) if self.offsets else 0
+
+    def stddev(self) -> float:
+        """ :return: the standard deviation of the offsets in milliseconds, 0 without hits """
+        if not self.offsets:
+            return 0
+        mean = self.mean()
+        return (sum((offset - mean) ** 2 for offset in self.offsets) / len(self.offsets)) ** 0.5
+
+    def early(self) -> int:
+        """ :return: the amount of hits before their beats """
+        return sum(1 for offset in self.offsets if offset < 0)
+
+    def late(self) -> int:
+        """ :return: the amount of hits after their beats """
+        return sum(1 for offset in self.offsets if offset > 0)
+
+    def histogram(self) -> list[int]:
+        """ :return: counts of hits in BIN wide bins covering the hit window, from the earliest to the latest """
+        half = Line.TIMEFRAME / 2
+        counts = [0] * int(Line.TIMEFRAME / TimingStats.BIN)
+        for offset in self.offsets:
+            counts[min(int((offset + half) // TimingStats.BIN), len(counts) - 1)] += 1
+        return counts
+
+    def summary(self) -> str:
+        """ :return: one line describing the offsets """
+        if not self.offsets:
+            return "No hits"
+        return (f"Timing {self.mean():+.0f} ms, spread {self.stddev():.0f} ms, "
+                f"{self.early()} early, {self.late()} late")
 
 
 if __name__ == '__main__':
@@ -244,8 +401,10 @@ if __name__ == '__main__':
                 finished = True
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_SPACE:
-                    if beatline.is_active():
-                        print(score)
+                    hit = beatline.judge()
+                    if hit is not None:
+                        beatline.use(hit[0])
+                        print(score, f"{hit[1]:+.0f} ms")
                         score += 1
 
         beatline.update()
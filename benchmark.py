@@ -0,0 +1,317 @@
+import argparse
+import json
+import math
+import os
+import platform
+import time
+import timeit
+import tracemalloc
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+from locals import *
+from chunks import ctype_by_letter, parse_chunk
+from model import Cell, Tower, PreparedChunk
+from spritesheet import SpriteSheet
+import beatline
+from controls import Input
+
+"""
+Measures the cost of performance-sensitive parts of the game.
+Runs headless under the dummy SDL drivers, launch from the repository root
+
+Functions:
+
+    legacy_load_chunk(chunk_path, spritesheet) -> list[list[Cell]]
+    surface_bytes(surfaces) -> int
+    bench_load_chunk(repeat=200) -> None
+    bench_display(frames=300) -> None
+    percentile(samples, q) -> float
+    menu_script(state, frame) -> list[pygame.event.Event]
+    session_script(state, frame) -> list[pygame.event.Event]
+    bench_states(frames=300) -> dict
+    compare(baseline, results, threshold=0.25) -> list[str]
+    format_states(results, baseline=None) -> str
+
+Constants:
+
+    CHUNK_PATH
+    BASELINE_PATH
+    BENCHMARKS
+    PHASES
+    SEED
+    MENU_KEYS, SESSION_KEYS
+"""
+
+CHUNK_PATH = os.path.join('resources', 'chunks', '1', '1_1.txt')
+BASELINE_PATH = 'benchmark_baseline.json'
+BENCHMARKS = ['chunks', 'display', 'states']
+PHASES = ['handle', 'update', 'render']
+SEED = 0  # seed of the benchmarked GameSession, see GameSession
+MENU_KEYS = [pygame.K_s, pygame.K_d, pygame.K_s, pygame.K_a, pygame.K_w, pygame.K_w]  # never trigger a button
+SESSION_KEYS = 'wwadhwjkwl'
+
+
+def legacy_load_chunk(chunk_path: str, spritesheet: SpriteSheet) -> list[list[Cell]]:
+    """ Loads chunk the way it was done before TileSet: a freshly cropped and scaled surface per tile
+    :param chunk_path: Path of the chunk file
+    :param spritesheet: Tower spritesheet to crop tiles from
+    :return: Rows of cells, listed from bottom to top
+    """
+    dump = open(chunk_path, 'r').readlines()
+    dump.reverse()
+    a = int(0.8 * HEIGHT / Tower.HEIGHT)
+    return [[Cell((a, a), ctype_by_letter[sym][0], spritesheet.image_at(ctype_by_letter[sym][1]))
+             for sym in line.strip()] for line in dump]
+
+
+def surface_bytes(surfaces) -> int:
+    """
+    :param surfaces: Iterable of surfaces
+    :return: Amount of pixel memory referenced, each distinct surface counted once
+    """
+    distinct = {id(surf): surf for surf in surfaces}
+    return sum(surf.get_width() * surf.get_height() * surf.get_bytesize() for surf in distinct.values())
+
+
+def bench_load_chunk(repeat: int = 200) -> None:
+    """ Compares preparing a chunk (shared tiles and a pre-rendered strip) against the per-tile surface loader
+    :param repeat: The amount of chunk loads to time for each variant
+    """
+    spritesheet = SpriteSheet('towersheet.png')
+    cell_length = 0.8 * HEIGHT / Tower.HEIGHT
+    legacy = legacy_load_chunk(CHUNK_PATH, spritesheet)
+    prepared = PreparedChunk(parse_chunk(CHUNK_PATH), cell_length)
+    results = {}
+    for name, load, surfaces, rows in (
+            ("legacy", lambda: legacy_load_chunk(CHUNK_PATH, spritesheet),
+             [cell.image for row in legacy for cell in row], len(legacy)),
+            ("prepared", lambda: PreparedChunk(parse_chunk(CHUNK_PATH), cell_length),
+             [prepared.strip], len(prepared))):
+        seconds = timeit.timeit(load, number=repeat)
+        results[name] = seconds / repeat
+        print(f"{name:>8}: {seconds / repeat * 1e6:10.1f} us/chunk, "
+              f"{surface_bytes(surfaces) / rows:12.1f} surface bytes/row")
+    print(f" speedup: {results['legacy'] / results['prepared']:.1f}x")
+    print("    note: strips take as much memory per row as per-tile surfaces, traded for one blit per chunk;\n"
+          "          they are only kept for the chunks held by the tower and its prefetcher")
+
+
+def present_full(screen: pygame.Surface, game) -> None:
+    """ Renders straight onto the display and pushes all of it """
+    screen.fill(Color.BLACK)
+    game.render(screen)
+    pygame.display.update()
+
+
+def present_dirty(screen: pygame.Surface, game) -> None:
+    """ Renders the changed areas and pushes them to the display, the way the main loop does """
+    import main
+    rects = main.redraw(screen, game, game.dirty_rects())
+    if rects:
+        pygame.display.update(rects)
+
+
+def bench_display(frames: int = 300) -> None:
+    """ Compares full-screen and dirty-rectangle display updates in the menu and in game
+    :param frames: The amount of frames to time for each state and variant
+    """
+    import main
+    screen = pygame.display.get_surface()
+    game = main.Game()
+    for state, build in ((main.MainMenu, main.MainMenu),
+                         (main.GameSession, lambda: main.GameSession(save_replay=False))):
+        for name, present in (("full", present_full), ("dirty", present_dirty)):
+            main.Game.switch_to(build())
+            start = time.perf_counter()
+            for _ in range(frames):
+                Input.get_instance().snapshot()
+                game.update()
+                present(screen, game)
+            print(f"{state.__name__:>12} {name:>5}: {(time.perf_counter() - start) / frames * 1e3:8.3f} ms/frame")
+            if isinstance(game.state, main.GameSession):
+                game.state.tower.close()
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """
+    :param samples: Measured values
+    :param q: Percentile from 0 to 100
+    :return: the smallest sample not exceeded by q percent of the samples
+    """
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def menu_script(state, frame: int) -> list[pygame.event.Event]:
+    """ Walks through the buttons and scrolls a menu every 10 frames, without triggering any button
+    :param state: Benchmarked menu
+    :param frame: Number of the frame
+    :return: Events to handle during the frame
+    """
+    if frame % 10:
+        return []
+    return [pygame.event.Event(pygame.KEYDOWN, key=MENU_KEYS[frame // 10 % len(MENU_KEYS)])]
+
+
+def session_script(state, frame: int) -> list[pygame.event.Event]:
+    """ Presses a key on every beat, cycling through moves and abilities
+    :param state: Benchmarked GameSession
+    :param frame: Number of the frame
+    :return: Events to handle during the frame
+    """
+    index = state.beatline.active_index()
+    if index is None:
+        return []
+    return [pygame.event.Event(pygame.KEYDOWN, key=ord(SESSION_KEYS[index % len(SESSION_KEYS)]))]
+
+
+def bench_states(frames: int = 300) -> dict:
+    """ Runs every GameState for a number of scripted frames, timing handle, update and render separately.
+    GameSession is seeded and driven by a FrameClock, so every run sees the same frames.
+    Each state runs twice: once for timing, once under tracemalloc to count Python heap allocations,
+    pixel memory of surfaces is allocated by SDL and is not included
+    :param frames: The amount of frames to run each state for
+    :return: dict mapping state names to dicts mapping phases to their statistics
+    """
+    import main
+    states = [
+        (main.MainMenu, main.MainMenu, menu_script),
+        (main.MusicSelectionMenu, main.MusicSelectionMenu, menu_script),
+        (main.AbilitySelectionMenu, main.AbilitySelectionMenu, menu_script),
+        (main.GameSession, lambda: main.GameSession(SEED, beatline.FrameClock(), save_replay=False), session_script),
+        (main.GameOver, lambda: main.GameOver(42), menu_script),
+    ]
+    track = MUSIC.TITLES.index(MUSIC.TITLE)
+    abilities = main.Settings.get_instance().ability_bar.names()
+    game = main.Game()
+    target = pygame.Surface((WIDTH, HEIGHT)).convert()
+
+    def render_into(state):
+        """ Clears the target and renders into it, the way the main loop does """
+        target.fill(Color.BLACK)
+        state.render(target)
+
+    results = {}
+    for state_type, create, script in states:
+        samples = {phase: {'time': [], 'alloc': []} for phase in PHASES}
+        restarts = 0
+        for traced in (False, True):
+            main.Game.switch_to(create())
+            if traced:
+                tracemalloc.start()
+            for frame in range(frames):
+                if not isinstance(game.state, state_type):
+                    # the player fell, start over with the same seed
+                    main.Game.switch_to(create())
+                    restarts += not traced
+                state = game.state
+                Input.get_instance().snapshot()
+                calls = {'handle': lambda: [state.handle(event) for event in script(state, frame)],
+                         'update': state.update,
+                         'render': lambda: render_into(state)}
+                for phase in PHASES:
+                    if traced:
+                        before = tracemalloc.get_traced_memory()[0]
+                        tracemalloc.reset_peak()
+                        calls[phase]()
+                        samples[phase]['alloc'].append(tracemalloc.get_traced_memory()[1] - before)
+                    else:
+                        start = time.perf_counter()
+                        calls[phase]()
+                        samples[phase]['time'].append((time.perf_counter() - start) * 1e3)
+            if traced:
+                tracemalloc.stop()
+            if isinstance(game.state, main.GameSession):
+                game.state.tower.close()
+        results[state_type.__name__] = {phase: {
+            'mean_ms': sum(samples[phase]['time']) / frames,
+            'p95_ms': percentile(samples[phase]['time'], 95),
+            'p99_ms': percentile(samples[phase]['time'], 99),
+            'alloc_kb': sum(samples[phase]['alloc']) / frames / 1024,
+        } for phase in PHASES}
+        results[state_type.__name__]['restarts'] = restarts
+        # menus change the selected track and abilities, put them back
+        MUSIC.set_title(track)
+        main.Settings.get_instance().ability_bar.set_abilities(abilities)
+    return results
+
+
+def compare(baseline: dict, results: dict, threshold: float = 0.25) -> list[str]:
+    """ Finds phases which got slower or allocate more than in the baseline
+    :param baseline: Results of an earlier bench_states run
+    :param results: Results of the current bench_states run
+    :param threshold: Relative change regarded as a regression
+    :return: Descriptions of the regressions
+    """
+    regressions = []
+    for state, phases in results.items():
+        for phase in PHASES:
+            if state not in baseline:
+                continue
+            for stat in ('mean_ms', 'p95_ms', 'alloc_kb'):
+                old, new = baseline[state][phase][stat], phases[phase][stat]
+                if new > old * (1 + threshold) and new - old > 0.01:
+                    change = (new / old - 1) * 100 if old else math.inf
+                    regressions.append(f"{state}.{phase} {stat}: {old:.3f} -> {new:.3f} (+{change:.0f}%)")
+    return regressions
+
+
+def format_states(results: dict, baseline: dict = None) -> str:
+    """
+    :param results: Results of a bench_states run
+    :param baseline: optional, results of an earlier run to show the changes against
+    :return: Human-readable table
+    """
+    lines = [f"{'state':>20} {'phase':>7} {'mean ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'alloc KB':>9}"]
+    for state, phases in results.items():
+        for phase in PHASES:
+            stats = phases[phase]
+            line = (f"{state:>20} {phase:>7} {stats['mean_ms']:9.3f} {stats['p95_ms']:9.3f} "
+                    f"{stats['p99_ms']:9.3f} {stats['alloc_kb']:9.1f}")
+            if baseline and state in baseline:
+                old = baseline[state][phase]
+                line += f"   was {old['mean_ms']:7.3f} {old['p95_ms']:7.3f} {old['p99_ms']:7.3f} {old['alloc_kb']:7.1f}"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the cost of performance-sensitive parts of the game")
+    parser.add_argument("targets", nargs="*", default=BENCHMARKS,
+                        help=f"benchmarks to run out of {', '.join(BENCHMARKS)}, all by default")
+    parser.add_argument("--frames", type=int, default=300, help="frames per state for the states benchmark")
+    parser.add_argument("--save", nargs="?", const=BASELINE_PATH, default=None,
+                        help=f"save the states results as the baseline, {BASELINE_PATH} by default")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_PATH, default=None,
+                        help=f"compare the states results against a baseline, {BASELINE_PATH} by default")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative slowdown regarded as a regression, frame times vary by ~20%% between runs")
+    args = parser.parse_args()
+    for target in args.targets:
+        if target not in BENCHMARKS:
+            parser.error(f"unknown benchmark {target}")
+
+    pygame.init()
+    pygame.display.set_mode((WIDTH, HEIGHT))
+    if "chunks" in args.targets:
+        bench_load_chunk()
+    if "display" in args.targets:
+        bench_display()
+    if "states" in args.targets:
+        results = bench_states(args.frames)
+        baseline = None
+        if args.compare:
+            with open(args.compare, 'r') as f:
+                baseline = json.load(f)['states']
+        print(format_states(results, baseline))
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({'frames': args.frames, 'python': platform.python_version(),
+                           'pygame': pygame.version.ver, 'states': results}, f, indent=2)
+        if baseline is not None:
+            regressions = compare(baseline, results, args.threshold)
+            print("\n".join(regressions) if regressions else "no regressions")
+            raise SystemExit(1 if regressions else 0)
@@ -1,10 +1,12 @@
 import pygame
 from pygame.rect import Rect
 
-from locals import FONT_PATH, Color
+from assets import Assets
+from controls import Dispatcher, Input
+from locals import FONT_PATH, FRAME_TIME, Color
 
 """ 
-Implements buttons and keyboard nevigation through menues
+Implements buttons and keyboard nevigation through menues, input is routed by a controls.Dispatcher
 
 Classes:
 
@@ -33,7 +35,7 @@ class Button:
 
     FONTSIZE_SMALL = 60
     FONTSIZE_BIG = 70
-    ANIMATION_SPEED = 0.8
+    ANIMATION_SPEED = 24  # font size growth per second while hovered
     FONT_PATH = FONT_PATH
     COLOR = Color.WHITE
 
@@ -50,6 +52,8 @@ class Button:
         self.update_text(text)
         self.keys = keys
         self.active = False
+        self.drawn_state = None  # (text, fontsize, active) as of the last dirty_rects() call
+        self.drawn_bounds = None
 
     def set_active(self, active: bool = True) -> None:
         """ Activates or deactivates button
@@ -63,49 +67,86 @@ class Button:
         screen.blit(self.text_surface, self.text_rect)
         if self.active:
             # Renders pointer (">") to the active button
-            text_surface = self.font.render("> ", True, Button.COLOR)
+            text_surface = Assets.get_instance().text("> ", self.fontsize, Button.COLOR, Button.FONT_PATH)
             text_rect = text_surface.get_rect(topright=self.text_rect.topleft)
             screen.blit(text_surface, text_rect)
 
     def update_text(self, text="") -> None:
-        """ Redraws button with new fontsize and (optionaly) text
+        """ Redraws button with new fontsize and (optionaly) text, fonts and text come from the shared cache
         :param text: New text
         """
         if text:
             self.text = text
-        self.font = pygame.font.Font(FONT_PATH, int(self.fontsize))
-        self.text_surface = self.font.render(trim(self.text), True, Button.COLOR)
+        assets = Assets.get_instance()
+        self.font = assets.font(self.fontsize, Button.FONT_PATH)
+        self.text_surface = assets.text(trim(self.text), self.fontsize, Button.COLOR, Button.FONT_PATH)
+        self.text_size = int(self.fontsize)  # the font size the text surface was rendered with
         self.text_rect = self.text_surface.get_rect(center=self.center)
-
-    def update(self) -> None:
-        """ Animates button """
+        self.pointer_rect = Rect((0, 0), self.font.size("> "))
+        self.pointer_rect.topright = self.text_rect.topleft
+
+    def get_bounds(self) -> Rect:
+        """ :return: Rect covering everything the button may draw, pointer included """
+        return self.text_rect.union(self.pointer_rect)
+
+    def dirty_rects(self) -> list[Rect]:
+        """ :return: List of screen areas which changed since the previous call """
+        state = (self.text, self.fontsize, self.active)
+        if state == self.drawn_state:
+            return []
+        bounds = self.get_bounds()
+        rects = [bounds.union(self.drawn_bounds) if self.drawn_bounds else bounds]
+        self.drawn_state, self.drawn_bounds = state, bounds
+        return rects
+
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ Animates button
+        :param dt: the amount of milliseconds since the previous update
+        """
         if self.is_mouse_on():
-            self.fontsize += Button.ANIMATION_SPEED
+            self.fontsize += Button.ANIMATION_SPEED * dt / 1000
         else:
-            self.fontsize -= Button.ANIMATION_SPEED
+            self.fontsize -= Button.ANIMATION_SPEED * dt / 1000
         # This checks that fontsize in inside [FONTSIZE_SMALL, FONTSIZE_BIG]
         self.fontsize = max(Button.FONTSIZE_SMALL, self.fontsize)
         self.fontsize = min(Button.FONTSIZE_BIG, self.fontsize)
-        # This redraws button image and recalculates rect
-        self.update_text()
+        # This redraws button image and recalculates rect once the drawn size changes
+        if int(self.fontsize) != self.text_size:
+            self.update_text()
 
-    def is_mouse_on(self) -> bool:
+    def is_settled(self) -> bool:
+        """ :return: True if the font size reached the size of the current hover state, so updates change nothing """
+        return self.fontsize == (Button.FONTSIZE_BIG if self.is_mouse_on() else Button.FONTSIZE_SMALL)
+
+    def is_mouse_on(self, pos: tuple[int, int] = None) -> bool:
         """ Checks if mouse is hovering over the button
+        :param pos: optional, position (x, y) to check instead of the mouse
         :returns : True if mouse is hovering over the button
         """
-        return self.text_rect.collidepoint(pygame.mouse.get_pos())
+        return self.text_rect.collidepoint(pos if pos is not None else Input.get_instance().mouse)
 
-    def handle(self, event: pygame.event.Event) -> None:
-        """ Handles mouse clicks and key presses
-        :param event: PyGame event to be handled
+    def get_max_bounds(self) -> Rect:
+        """ :return: Rect covering the button at its biggest font size """
+        width, height = Assets.get_instance().font(Button.FONTSIZE_BIG, Button.FONT_PATH).size(trim(self.text))
+        return Rect(0, 0, width, height).move(self.center[0] - width // 2, self.center[1] - height // 2)
+
+    def register_clicks(self, dispatcher: Dispatcher) -> None:
+        """ Registers the click area of the button
+        :param dispatcher: Dispatcher of the menu
         """
-        should_trigger = ((event.type == pygame.MOUSEBUTTONDOWN and self.is_mouse_on())
-                          or (event.type == pygame.KEYDOWN and self.keys and event.key in self.keys)
-                          or (event.type == pygame.KEYDOWN and self.active and event.key == pygame.K_RETURN))
+        dispatcher.on_click(self.get_max_bounds(), self.is_mouse_on, lambda event: self.trigger())
 
-        if should_trigger and self.action is not None:
+    def trigger(self) -> None:
+        """ Calls the action of the button """
+        if self.action is not None:
             self.action()
 
+    def shift(self, step: int) -> None:
+        """ Buttons have no entries to choose from
+        :param step: ignored
+        """
+        pass
+
 
 class Scroll:
     """ Provides selection from the number of entries.
@@ -121,6 +162,7 @@ class Scroll:
 
     FONTSIZE_SMALL = 60
     FONTSIZE_BIG = 64
+    ANIMATION_SPEED = 30  # arrow font size growth per second while hovered
     FONT_PATH = FONT_PATH
     COLOR = Color.WHITE
 
@@ -140,38 +182,44 @@ class Scroll:
         self.size_left = Scroll.FONTSIZE_SMALL
         self.size_right = Scroll.FONTSIZE_SMALL
         self.update_surface()
+        self.drawn_state = None  # (i, size_left, size_right, arrows shown) as of the last dirty_rects() call
+        self.drawn_bounds = None
 
     def update_surface(self) -> None:
-        """ Redraws scroll, arrows and recalculates hitbox """
-        font = pygame.font.Font(Scroll.FONT_PATH, Scroll.FONTSIZE_SMALL)
-        font_left = pygame.font.Font(Scroll.FONT_PATH, self.size_left)
-        font_right = pygame.font.Font(Scroll.FONT_PATH, self.size_right)
+        """ Redraws scroll, arrows and recalculates hitbox, text comes from the shared cache """
+        assets = Assets.get_instance()
         # Text
-        self.text_surface = font.render(trim(self.options[self.i]), True, Button.COLOR)
+        self.text_surface = assets.text(trim(self.options[self.i]), Scroll.FONTSIZE_SMALL, Button.COLOR,
+                                        Scroll.FONT_PATH)
         self.text_rect = self.text_surface.get_rect(center=self.center)
         # Arrows
-        self.left_surface = font_left.render(" < ", True, Button.COLOR)
+        self.left_surface = assets.text(" < ", self.size_left, Button.COLOR, Scroll.FONT_PATH)
         self.left_rect = self.left_surface.get_rect(midright=self.text_rect.midleft)
-        self.right_surface = font_right.render(" > ", True, Button.COLOR)
+        self.right_surface = assets.text(" > ", self.size_right, Button.COLOR, Scroll.FONT_PATH)
+        self.drawn_surface = (self.i, int(self.size_left), int(self.size_right))  # what the surfaces show
         self.right_rect = self.right_surface.get_rect(midleft=self.text_rect.midright)
 
-    def update(self) -> None:
-        """ Animates scroll """
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ Animates scroll
+        :param dt: the amount of milliseconds since the previous update
+        """
         # Increases fontsize when mouse is hovering
+        growth = Scroll.ANIMATION_SPEED * dt / 1000
         if self.is_mouse_on_left():
-            self.size_left += 1
+            self.size_left += growth
         else:
-            self.size_left -= 1
+            self.size_left -= growth
         if self.is_mouse_on_right():
-            self.size_right += 1
+            self.size_right += growth
         else:
-            self.size_right -= 1
+            self.size_right -= growth
         # Makes sure fontsizes are in range [FONTSIZE_SMALL, FONTSIZE_BIG]
         self.size_left = max(Button.FONTSIZE_SMALL, self.size_left)
         self.size_left = min(Button.FONTSIZE_BIG, self.size_left)
         self.size_right = max(Button.FONTSIZE_SMALL, self.size_right)
         self.size_right = min(Button.FONTSIZE_BIG, self.size_right)
-        self.update_surface()
+        if (self.i, int(self.size_left), int(self.size_right)) != self.drawn_surface:
+            self.update_surface()
 
     def render(self, screen: pygame.Surface) -> None:
         """ Blits button image onto given surface
@@ -182,48 +230,85 @@ class Scroll:
             screen.blit(self.left_surface, self.left_rect)
             screen.blit(self.right_surface, self.right_rect)
 
+    def get_bounds(self) -> Rect:
+        """ :return: Rect covering the text and both arrows """
+        return self.text_rect.union(self.left_rect).union(self.right_rect)
+
+    def dirty_rects(self) -> list[Rect]:
+        """ :return: List of screen areas which changed since the previous call """
+        state = (self.i, self.size_left, self.size_right, self.active or self.is_mouse_on())
+        if state == self.drawn_state:
+            return []
+        bounds = self.get_bounds()
+        rects = [bounds.union(self.drawn_bounds) if self.drawn_bounds else bounds]
+        self.drawn_state, self.drawn_bounds = state, bounds
+        return rects
+
     def set_active(self, active: bool = True) -> None:
         """ Activates or deactivates scroll
         :param active: True if scroll should be activated """
         self.active = active
 
-    def handle(self, event: pygame.event.Event) -> None:
-        """ Handles key AD/LeftRight entry change
-        :param event: PyGame event to be handled
+    def shift(self, step: int) -> None:
+        """ Chooses another entry
+        :param step: the amount of entries to move by, negative to move left
         """
         prev_i = self.i
-
-        if event.type == pygame.KEYDOWN and self.active:
-            if event.key == pygame.K_a or event.key == pygame.K_LEFT:
-                self.i = (self.i - 1) % len(self.options)
-            if event.key == pygame.K_d or event.key == pygame.K_RIGHT:
-                self.i = (self.i + 1) % len(self.options)
-
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            if self.is_mouse_on_left():
-                self.i = (self.i - 1) % len(self.options)
-            if self.is_mouse_on_right():
-                self.i = (self.i + 1) % len(self.options)
-
+        self.i = (self.i + step) % len(self.options)
         if prev_i != self.i and self.post_action is not None:
             self.post_action(self.i)
 
-    def is_mouse_on_left(self) -> bool:
-        """ :return: True if mouse is hovering over the left arrow """
-        return self.left_rect.collidepoint(pygame.mouse.get_pos())
+    def trigger(self) -> None:
+        """ Scrolls have no action """
+        pass
+
+    def get_max_bounds(self) -> Rect:
+        """ :return: Rect covering the scroll with its longest entry and the biggest arrows """
+        assets = Assets.get_instance()
+        font = assets.font(Scroll.FONTSIZE_SMALL, Scroll.FONT_PATH)
+        arrows = assets.font(Button.FONTSIZE_BIG, Scroll.FONT_PATH)
+        width = max(font.size(trim(option))[0] for option in self.options)
+        width += arrows.size(" < ")[0] + arrows.size(" > ")[0]
+        height = max(font.get_height(), arrows.get_height())
+        return Rect(0, 0, width, height).move(self.center[0] - width // 2, self.center[1] - height // 2)
+
+    def register_clicks(self, dispatcher: Dispatcher) -> None:
+        """ Registers the click areas of the arrows
+        :param dispatcher: Dispatcher of the menu
+        """
+        bounds = self.get_max_bounds()
+        dispatcher.on_click(bounds, self.is_mouse_on_left, lambda event: self.shift(-1))
+        dispatcher.on_click(bounds, self.is_mouse_on_right, lambda event: self.shift(1))
+
+    def is_settled(self) -> bool:
+        """ :return: True if both arrows reached the size of their hover state, so updates change nothing """
+        return (self.size_left == (Button.FONTSIZE_BIG if self.is_mouse_on_left() else Button.FONTSIZE_SMALL)
+                and self.size_right == (Button.FONTSIZE_BIG if self.is_mouse_on_right() else Button.FONTSIZE_SMALL))
+
+    def is_mouse_on_left(self, pos: tuple[int, int] = None) -> bool:
+        """
+        :param pos: optional, position (x, y) to check instead of the mouse
+        :return: True if mouse is hovering over the left arrow
+        """
+        return self.left_rect.collidepoint(pos if pos is not None else Input.get_instance().mouse)
 
-    def is_mouse_on_right(self) -> bool:
-        """ :return: True if mouse is hovering over the right arrow """
-        return self.right_rect.collidepoint(pygame.mouse.get_pos())
+    def is_mouse_on_right(self, pos: tuple[int, int] = None) -> bool:
+        """
+        :param pos: optional, position (x, y) to check instead of the mouse
+        :return: True if mouse is hovering over the right arrow
+        """
+        return self.right_rect.collidepoint(pos if pos is not None else Input.get_instance().mouse)
 
     def is_mouse_on(self) -> bool:
         """ :return: True if mouse is hovering over the scroll"""
-        return (self.text_rect.collidepoint(pygame.mouse.get_pos())
+        return (self.text_rect.collidepoint(Input.get_instance().mouse)
                 or self.is_mouse_on_left() or self.is_mouse_on_right())
 
 
 class ButtonList:
-    """ Stores a set of buttons, implements navigation. """
+    """ Stores a set of buttons, implements navigation.
+    Buttons are only updated and checked for changes after input, mouse movement or while they are animating,
+    an idle menu costs next to nothing """
 
     def __init__(self, topmid: tuple[int, int], h_step: int):
         """ Initializes empty button list and sets layout
@@ -233,14 +318,26 @@ class ButtonList:
         self.i = 0
         self.topmid = topmid
         self.h_step = h_step
-
-    def add_button(self, button: Button) -> None:
+        self.mouse = None  # mouse position as of the last update
+        self.settled = False  # True if no button was animating at the last update
+        self.changed = True  # True if buttons may have changed since the last dirty_rects() call
+        self.dispatcher = Dispatcher()
+        self.dispatcher.on_action("up", lambda event: self.select(self.i - 1))
+        self.dispatcher.on_action("down", lambda event: self.select(self.i + 1))
+        self.dispatcher.on_action("confirm", lambda event: self.buttons[self.i].trigger())
+        self.dispatcher.on_action("left", lambda event: self.buttons[self.i].shift(-1))
+        self.dispatcher.on_action("right", lambda event: self.buttons[self.i].shift(1))
+
+    def add_button(self, button) -> None:
         """ Add already existing button
-        :param button: Button instance to add to list
+        :param button: Button or Scroll instance to add to list
         ..note:: It is preferable to use construct_button()"""
         if not self.buttons:
             button.set_active()
         self.buttons.append(button)
+        for key in getattr(button, "keys", None) or ():
+            self.dispatcher.on_key(key, lambda event, pressed=button: pressed.trigger())
+        self.invalidate()
 
     def construct_button(self, text: str, action=None, keys=None) -> None:
         """ Creates new button in place
@@ -250,10 +347,7 @@ class ButtonList:
         """
         width, height = self.buttons[-1].center if self.buttons else self.topmid
         height += self.h_step if self.buttons else 0
-        new_button = Button(text, (width, height), action, keys)
-        if not self.buttons:
-            new_button.set_active()
-        self.buttons.append(new_button)
+        self.add_button(Button(text, (width, height), action, keys))
 
     def construct_scroll(self, options: list[str], post_action=None, starting_i: int = 0):
         """ Creates and appends new scroll
@@ -264,10 +358,7 @@ class ButtonList:
         """
         width, height = self.buttons[-1].center if self.buttons else self.topmid
         height += self.h_step if self.buttons else 0
-        new_scroll = Scroll(options, (width, height), post_action, starting_i)
-        if not self.buttons:
-            new_scroll.set_active()
-        self.buttons.append(new_scroll)
+        self.add_button(Scroll(options, (width, height), post_action, starting_i))
 
     def render(self, screen: pygame.Surface) -> None:
         """ Renders buttons and scrolls
@@ -276,26 +367,50 @@ class ButtonList:
         for button in self.buttons:
             button.render(screen)
 
-    def update(self) -> None:
-        """ Animates buttons """
+    def invalidate(self) -> None:
+        """ Makes the next update and dirty_rects() call check every button and registers their click areas again,
+        to be called after changing buttons from the outside, e.g. with Button.update_text """
+        self.settled = False
+        self.changed = True
+        self.dispatcher.clear_clicks()
+        for button in self.buttons:
+            button.register_clicks(self.dispatcher)
+
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ Animates buttons, does nothing if they are settled and the mouse didn't move
+        :param dt: the amount of milliseconds since the previous update
+        """
+        mouse = Input.get_instance().mouse
+        if self.settled and mouse == self.mouse:
+            return
+        self.mouse = mouse
         for button in self.buttons:
-            button.update()
+            button.update(dt)
+        self.settled = all(button.is_settled() for button in self.buttons)
+        self.changed = True
+
+    def dirty_rects(self) -> list[Rect]:
+        """ :return: List of screen areas changed by any of the buttons since the previous call """
+        if not self.changed:
+            return []
+        self.changed = False
+        return [rect for button in self.buttons for rect in button.dirty_rects()]
+
+    def select(self, i: int) -> None:
+        """ Makes another button active
+        :param i: Index of the button, wraps around
+        """
+        self.buttons[self.i].set_active(active=False)
+        self.i = i % len(self.buttons)
+        self.buttons[self.i].set_active()
 
     def handle(self, event: pygame.event.Event) -> None:
         """ Handles button navigation and activation through clicks or keystrokes
         :param event: PyGame event to be handled
         """
-        if event.type == pygame.KEYDOWN:
-            prev_i = self.i
-            if event.key == pygame.K_w or event.key == pygame.K_UP:
-                self.i = (self.i - 1) % len(self.buttons)
-            if event.key == pygame.K_s or event.key == pygame.K_DOWN:
-                self.i = (self.i + 1) % len(self.buttons)
-            # Update active button 
-            self.buttons[prev_i].set_active(active=False)
-            self.buttons[self.i].set_active()
-        for button in self.buttons:
-            button.handle(event)
+        if self.dispatcher.dispatch(event):
+            self.settled = False
+            self.changed = True
 
 
 if __name__ == '__main__':
@@ -312,15 +427,17 @@ if __name__ == '__main__':
 
     def cool_action(i):
         buttons.buttons[1].update_text(names[i])
+        buttons.invalidate()
 
 
-    buttons.construct_scroll(names, lambda i: buttons.buttons[1].update_text(names[i]))
+    buttons.construct_scroll(names, cool_action)
     clock = pygame.time.Clock()
     finished = False
 
     # Main cycle
     while not finished:
         clock.tick(60)
+        Input.get_instance().snapshot()
         # Handles events
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
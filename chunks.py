@@ -1,18 +1,43 @@
+import bisect
+import hashlib
+import json
+import math
 import os.path
+import random
 
 """
 Resposible for converting human-readable chunks into game-readable type
+and for keeping the parsed chunk pool in memory
+
+Classes:
+
+    AliasTable
+    ChunkCatalog
 
 Functions:
 
     redo_chunk(filename) -> None
+    parse_chunk(chunk_path) -> tuple[str, ...]
 
 Constants:
 
     letter_by_state
     ctype_by_letter
+    CHUNKS_DIR
+    DIFFICULTIES
+    INDEX_NAME
+    RAMP_LEVELS, LEVEL_STEP, SPREAD, TIER_GAP
 """
 
+CHUNKS_DIR = os.path.join('resources', 'chunks')
+DIFFICULTIES = ['0', '1', '2']
+INDEX_NAME = 'index.json'  # cached difficulty scores, see ChunkCatalog.refresh_index
+
+RAMP_LEVELS = 160  # level from which the hardest chunks are the most likely ones
+LEVEL_STEP = 10  # levels sharing one sampling table
+SPREAD = 0.1  # width of the chunk distribution around the target difficulty rank
+TIER_GAP = 0.1  # share of the rank range of every tier left empty at its edges
+
 letter_by_state = {
     -10: 'A',
     -4: 'B',
@@ -120,6 +145,157 @@ def redo_chunk(difficulty: str, filename: str) -> None:
             f.write('\n')
 
 
+def parse_chunk(chunk_path: str) -> tuple[str, ...]:
+    """ Reads a prepared (see redo_chunk) chunk file
+    :param chunk_path: Path of the chunk file
+    :return: Rows of chunk letters, listed from bottom to top
+    """
+    with open(chunk_path, 'r') as f:
+        rows = [line.strip() for line in f if line.strip()]
+    rows.reverse()
+    return tuple(rows)
+
+
+class AliasTable:
+    """ Samples indices with given weights in constant time per draw (Vose's alias method) """
+
+    def __init__(self, weights: list[float]):
+        """ Builds the table
+        :param weights: Non-negative weights, at least one of them positive
+        """
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def draw(self, rng: random.Random = random) -> int:
+        """
+        :param rng: Source of randomness
+        :return: Random index, distributed according to the weights
+        """
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+class ChunkCatalog:
+    """ Singleton pool of parsed chunks ranked by difficulty, read from disk only once, on first use.
+    The hand-curated tier sets the range of the rank, the measured score cached in INDEX_NAME orders chunks
+    within their tier. The index is only written by validator.py --index, the game just reads it """
+    _instance = None
+
+    def __init__(self, chunks_dir: str = CHUNKS_DIR):
+        """ Initializes empty catalog
+        :param chunks_dir: Directory with one subdirectory of chunk files per difficulty
+        """
+        ChunkCatalog._instance = self
+        self.chunks_dir = chunks_dir
+        self.ranked = None  # pairs (letters, difficulty rank from 0 to 1) of all chunks with rows
+        self.tables = {}  # AliasTable over self.ranked for every level step
+
+    @staticmethod
+    def get_instance():
+        """ :returns: the only instance of the class ChunkCatalog """
+        if ChunkCatalog._instance is None:
+            ChunkCatalog()
+        return ChunkCatalog._instance
+
+    def chunk_names(self) -> list[str]:
+        """ :return: Names of all chunk files as "<difficulty>/<file name>" """
+        return [f"{difficulty}/{name}" for difficulty in DIFFICULTIES
+                for name in sorted(os.listdir(os.path.join(self.chunks_dir, difficulty)))]
+
+    def read_index(self) -> dict:
+        """ :return: dict mapping chunk names to {"sha1": content hash, "score": score or None}
+            as last written by refresh_index, empty if there is no index """
+        index_path = os.path.join(self.chunks_dir, INDEX_NAME)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def chunk_hashes(self) -> dict:
+        """ :return: dict mapping the names of all chunk files to the sha1 of their content """
+        hashes = {}
+        for name in self.chunk_names():
+            with open(os.path.join(self.chunks_dir, name), 'rb') as f:
+                hashes[name] = hashlib.sha1(f.read()).hexdigest()
+        return hashes
+
+    def refresh_index(self, scorer=None) -> dict:
+        """ Loads cached difficulty scores and recomputes them for chunks that are new or changed
+        :param scorer: Function(list of chunk paths) -> list of scores, see validator.score_chunk.
+            Scores one chunk after another by default
+        :return: dict mapping chunk names to {"sha1": content hash, "score": score or None}
+        """
+        index_path = os.path.join(self.chunks_dir, INDEX_NAME)
+        index = self.read_index()
+        hashes = self.chunk_hashes()
+        stale = [name for name in hashes if name not in index or index[name]["sha1"] != hashes[name]]
+        if stale or set(index) != set(hashes):
+            if scorer is None:
+                from validator import score_chunk
+                scorer = lambda paths: [score_chunk(path) for path in paths]
+            scores = scorer([os.path.join(self.chunks_dir, name) for name in stale])
+            index = {name: index[name] for name in hashes if name not in stale}
+            index.update({name: {"sha1": hashes[name], "score": score} for name, score in zip(stale, scores)})
+            with open(index_path, 'w') as f:
+                json.dump(dict(sorted(index.items())), f, indent=1)
+        return index
+
+    def get_ranked(self) -> list[tuple[tuple[str, ...], float]]:
+        """ Ranks chunks by tier first, then by the measured difficulty within the tier:
+        tier i of len(DIFFICULTIES) gets ranks from i / len(DIFFICULTIES) to (i + 1) / len(DIFFICULTIES).
+        Chunks without an up-to-date score, being new or changed since the index was refreshed,
+        take the middle of their tier
+        :return: Pairs (letters, difficulty rank from 0 to 1) of all chunks with rows, from the easiest to the hardest
+        """
+        if self.ranked is None:
+            index = self.read_index()
+            tiers = {difficulty: [] for difficulty in DIFFICULTIES}  # difficulty -> [(score or None, letters)]
+            for name, sha1 in self.chunk_hashes().items():
+                letters = parse_chunk(os.path.join(self.chunks_dir, name))
+                if letters:
+                    entry = index.get(name, {})
+                    score = entry["score"]["difficulty"] if entry.get("sha1") == sha1 and entry["score"] else None
+                    tiers[name.split('/')[0]].append((score, letters))
+            ranked = []
+            for tier, difficulty in enumerate(DIFFICULTIES):
+                known = sorted(score for score, _ in tiers[difficulty] if score is not None)
+                for score, letters in tiers[difficulty]:
+                    within = 0.5
+                    if score is not None and len(known) > 1:
+                        within = bisect.bisect_left(known, score) / (len(known) - 1)
+                    # tiers are kept TIER_GAP apart, so the hardest chunk of a tier isn't drawn as often as
+                    # the easiest one of the next tier
+                    ranked.append(((tier + TIER_GAP / 2 + (1 - TIER_GAP) * within) / len(DIFFICULTIES), letters))
+            ranked.sort(key=lambda pair: pair[0])
+            self.ranked = [(letters, rank) for rank, letters in ranked]
+        return self.ranked
+
+    def choose_for_level(self, level: int, rng: random.Random = random) -> tuple[str, ...]:
+        """ Chooses chunk with difficulty rank near the target for the level, the target grows up to RAMP_LEVELS
+        :param level: the level of the floor of the tower
+        :param rng: Source of randomness
+        :return: Chosen chunk
+        """
+        step = min(max(level, 0), RAMP_LEVELS) // LEVEL_STEP
+        if step not in self.tables:
+            # from the middle of the easiest tier to the middle of the hardest one
+            target = (0.5 + (len(DIFFICULTIES) - 1) * step * LEVEL_STEP / RAMP_LEVELS) / len(DIFFICULTIES)
+            self.tables[step] = AliasTable([math.exp(-((rank - target) / SPREAD) ** 2 / 2)
+                                            for _, rank in self.get_ranked()])
+        return self.get_ranked()[self.tables[step].draw(rng)][0]
+
+
 if __name__ == '__main__':
     difficulty = input("difficulty ")
     chunk_name = input("chunk name or 'all' ")
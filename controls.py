@@ -0,0 +1,189 @@
+import json
+import os.path
+import pygame
+from simulation import MOVES, ABILITY_KEYS
+
+"""
+Central input layer. The mouse is read once per frame into Input,
+key presses are routed through per-owner tables of Dispatcher and clicks through a grid of clickable areas,
+so handling an event costs the same however many handlers are registered.
+Keys are bound to named actions by Bindings, which reads player overrides from BINDINGS_PATH
+
+Classes:
+
+    Bindings
+    Input
+    Dispatcher
+
+Constants:
+
+    GAME_ACTIONS
+    DEFAULT_BINDINGS
+    BINDINGS_PATH
+"""
+
+# Actions of a GameSession, named after their default keys as they are recorded in replays, see simulation.MOVES
+GAME_ACTIONS = list(MOVES) + ABILITY_KEYS
+# Action name -> names of the keys triggering it, see pygame.key.name
+DEFAULT_BINDINGS = {
+    **{action: [action] for action in GAME_ACTIONS},
+    # Menu navigation
+    "up": ["w", "up"],
+    "down": ["s", "down"],
+    "left": ["a", "left"],
+    "right": ["d", "right"],
+    "confirm": ["return"],
+}
+# JSON file of the same shape as DEFAULT_BINDINGS, its actions replace the default ones
+BINDINGS_PATH = "controls.json"
+
+
+class Bindings:
+    """ Singleton mapping keys to the actions they trigger, one key may trigger several actions """
+    _instance = None
+
+    def __init__(self, path: str = BINDINGS_PATH):
+        """ Binds the default keys, then the ones from the file if it exists.
+        Actions naming an unknown key in the file keep their default keys
+        :param path: optional, path of the JSON file with rebound actions
+        """
+        Bindings._instance = self
+        self.keys = {}  # action -> key ids
+        self.actions = {}  # key id -> actions
+        for action, names in DEFAULT_BINDINGS.items():
+            self.bind(action, names)
+        if os.path.exists(path):
+            with open(path) as f:
+                for action, names in json.load(f).items():
+                    try:
+                        self.bind(action, names)
+                    except ValueError as error:
+                        print(f"Keeping the default keys of {action}, {path} names an unknown key: {error}")
+
+    @staticmethod
+    def get_instance():
+        """ :returns: the only instance of the class Bindings """
+        if Bindings._instance is None:
+            Bindings()
+        return Bindings._instance
+
+    def bind(self, action: str, names: list[str]) -> None:
+        """ Replaces the keys of an action
+        :param action: Name of the action
+        :param names: Names of the keys, see pygame.key.name
+        """
+        self.keys[action] = [pygame.key.key_code(name) for name in names]
+        self.actions = {}
+        for bound_action, keys in self.keys.items():
+            for key in keys:
+                self.actions.setdefault(key, []).append(bound_action)
+
+    def actions_of(self, key: int) -> list[str]:
+        """
+        :param key: PyGame key id
+        :return: Actions triggered by the key
+        """
+        return self.actions.get(key, [])
+
+
+class Input:
+    """ Singleton holding the state of the mouse as of the start of the frame """
+    _instance = None
+
+    def __init__(self):
+        """ Reads the mouse for the first time """
+        Input._instance = self
+        self.mouse = (0, 0)
+        self.snapshot()
+
+    @staticmethod
+    def get_instance():
+        """ :returns: the only instance of the class Input """
+        if Input._instance is None:
+            Input()
+        return Input._instance
+
+    def snapshot(self) -> None:
+        """ Reads the mouse, called once per frame by the main loop """
+        self.mouse = pygame.mouse.get_pos()
+
+
+class Dispatcher:
+    """ Routes events of one owner to its handlers: key presses by key and action tables,
+    clicks by a grid of the areas which may be clicked. Handlers are functions(event) -> None """
+
+    CELL = 64  # size of a grid cell in pixels
+
+    def __init__(self):
+        """ Starts with no handlers """
+        self.keys = {}  # key id -> handlers
+        self.actions = {}  # action -> handlers
+        self.fallback = None  # handler of the keys nothing else handles
+        self.areas = []  # (bounds, hit, handler) of the clickable areas
+        self.grid = None  # (column, row) -> [(hit, handler)] of the areas overlapping the cell, None if outdated
+
+    def on_key(self, key: int, handler) -> None:
+        """
+        :param key: PyGame key id
+        :param handler: Function(event) called when the key is pressed
+        """
+        self.keys.setdefault(key, []).append(handler)
+
+    def on_action(self, action: str, handler) -> None:
+        """
+        :param action: Name of an action, see Bindings
+        :param handler: Function(event) called when any key bound to the action is pressed
+        """
+        self.actions.setdefault(action, []).append(handler)
+
+    def on_other_key(self, handler) -> None:
+        """
+        :param handler: Function(event) called when a key without any other handler is pressed
+        """
+        self.fallback = handler
+
+    def on_click(self, bounds: pygame.Rect, hit, handler) -> None:
+        """
+        :param bounds: Rect covering every position the area may ever take
+        :param hit: Function(pos) -> True if the area is at the position now
+        :param handler: Function(event) called when the area is clicked
+        """
+        self.areas.append((bounds, hit, handler))
+        self.grid = None
+
+    def clear_clicks(self) -> None:
+        """ Removes every clickable area, to register them again after they moved """
+        self.areas = []
+        self.grid = None
+
+    def index(self) -> None:
+        """ Files every clickable area under the grid cells it overlaps """
+        self.grid = {}
+        for bounds, hit, handler in self.areas:
+            for column in range(bounds.left // Dispatcher.CELL, (bounds.right - 1) // Dispatcher.CELL + 1):
+                for row in range(bounds.top // Dispatcher.CELL, (bounds.bottom - 1) // Dispatcher.CELL + 1):
+                    self.grid.setdefault((column, row), []).append((hit, handler))
+
+    def dispatch(self, event: pygame.event.Event) -> bool:
+        """ Calls the handlers of the event
+        :param event: PyGame event
+        :return: True if any handler was called
+        """
+        if event.type == pygame.KEYDOWN:
+            handlers = list(self.keys.get(event.key, ()))
+            for action in Bindings.get_instance().actions_of(event.key):
+                handlers += self.actions.get(action, ())
+            if not handlers and self.fallback is not None:
+                handlers = [self.fallback]
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            if self.grid is None:
+                self.index()
+            x, y = event.pos
+            cell = self.grid.get((x // Dispatcher.CELL, y // Dispatcher.CELL), ())
+            handlers = [handler for hit, handler in cell if hit(event.pos)]
+        else:
+            return False
+        # handlers may switch the game state, so they are only called once all of them are found
+        for handler in handlers:
+            handler(event)
+        return bool(handlers)
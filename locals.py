@@ -11,13 +11,17 @@ Classes:
 
 Constants:
 
-    FPS
-    WIDTH, HEIGHT
+    FPS, FRAME_TIME, POLL_INTERVAL
+    WIDTH, HEIGHT, FULL_REDRAW_SHARE
 
     FONT_NAME, FONT_SIZE
     
     TITLE
 
+    REPLAY_DIR
+
+    AUDIO_LATENCY
+
 Function:
 
     next_track() -> None
@@ -42,9 +46,14 @@ class Color:
 
 # Refresh rate
 FPS = 30
+FRAME_TIME = 1000 / FPS  # milliseconds per frame at the target refresh rate, animations are timed in milliseconds
+POLL_INTERVAL = 2  # milliseconds between input polls while waiting for the next frame, hits are timed this precisely
 
 # Screen resolution
 WIDTH, HEIGHT = 1280, 720
+# Share of the screen the changed areas may add up to before the whole screen is redrawn and pushed at once,
+# the tower, beatline and ability bar of a game take about 45%
+FULL_REDRAW_SHARE = 0.6
 
 # Font
 FONT_NAME = "SUPERSCR.TTF"
@@ -54,6 +63,12 @@ FONT_PATH = path.join('resources', 'fonts', FONT_NAME)
 # In-game text
 TITLE = "Higher"
 
+# Finished sessions are saved here, see replay.py
+REPLAY_DIR = "replays"
+
+# Milliseconds between the mixer playing a sample and it being heard, raise it if beats come early on your setup
+AUDIO_LATENCY = 0
+
 
 class TEXT:
     """ Stores game text messages as static variables """
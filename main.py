@@ -1,9 +1,16 @@
+import os
+import random
+import time
 import pygame
 from abc import ABC, abstractmethod
 from button import ButtonList, Button
 from model import Tower
 import beatline
 from abilities import ability_list, ability_names, AbilityBar
+from assets import Assets
+from controls import GAME_ACTIONS, Dispatcher, Input
+from simulation import Recording
+from perf import PerfMonitor
 from locals import *
 
 
@@ -14,7 +21,7 @@ class Settings:
     def __init__(self):
         """ initiates settings"""
         Settings._instance = self
-        self.ability_bar = AbilityBar(None)
+        self.ability_bar = AbilityBar()
 
     @staticmethod
     def get_instance():
@@ -35,9 +42,9 @@ class GameState(ABC):
         pass
 
     @abstractmethod
-    def render(self) -> pygame.Surface:
-        """ Composes all visible objects
-        :returns: pygame.Surface with the result
+    def render(self, screen: pygame.Surface) -> None:
+        """ Draws all visible objects
+        :param screen: Target surface, already cleared by the caller
         """
         pass
 
@@ -49,20 +56,34 @@ class GameState(ABC):
         pass
 
     @abstractmethod
-    def update(self) -> None:
-        """ Calculates new model and animation states """
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ Calculates new model and animation states
+        :param dt: the amount of milliseconds since the previous update
+        """
         pass
 
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ Reports which parts of the screen changed since the previous frame
+        :returns: List of changed screen areas, the whole screen by default
+        """
+        return [pygame.Rect(0, 0, WIDTH, HEIGHT)]
+
+    def perf_counters(self) -> dict:
+        """ :returns: State-specific counters shown on the performance overlay, see perf.PerfMonitor """
+        return {}
+
 
 class Game:
     """ Singleton wrapper class which resposibility is to allow state switching """
     state: GameState
     _instance = None
 
-    def __init__(self):
-        """ Initializes the only memeber """
+    def __init__(self, start=None):
+        """ Initializes the only memeber
+        :param start: optional, function() -> GameState creating the first state, MainMenu by default
+        """
         Game._instance = self
-        self.switch_to(MainMenu())
+        self.switch_to(start() if start is not None else MainMenu())
 
     def _switch_to(self, new_state: GameState) -> None:
         """ Changes game state
@@ -70,12 +91,21 @@ class Game:
         .. note: For internal use only
         """
         self.state = new_state
+        self.full_redraw = True
 
         # Passes over function calls to GameState object
         self.render = self.state.render
         self.handle = self.state.handle
         self.update = self.state.update
 
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :returns: Changed screen areas, the whole screen right after a state switch """
+        rects = self.state.dirty_rects()
+        if self.full_redraw:
+            self.full_redraw = False
+            return [pygame.Rect(0, 0, WIDTH, HEIGHT)]
+        return rects
+
     @staticmethod
     def switch_to(new_state: GameState) -> None:
         """ Changes game state
@@ -106,25 +136,25 @@ class MainMenu(GameState):
                                           action=exit,
                                           keys=[pygame.K_ESCAPE, pygame.K_BACKSPACE])
 
-        self.font = pygame.font.Font(FONT_PATH, FONT_SIZE)
+        self.assets = Assets.get_instance()
 
-    def render(self) -> pygame.Surface:
+    def render(self, screen: pygame.Surface) -> None:
         """ Renders title and menu buttons
-        :returns: PyGame surface with the result
+        :param screen: Target surface, already cleared by the caller
         """
-        screen = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
-
-        text_surface = self.font.render(TITLE, True, Color.WHITE)
+        text_surface = self.assets.text(TITLE, FONT_SIZE, Color.WHITE)
         text_rect = text_surface.get_rect(center=(WIDTH / 2, 0.1 * HEIGHT))
         screen.blit(text_surface, text_rect)
 
         self.button_list.render(screen)
 
-        return screen
-
-    def update(self) -> None:
+    def update(self, dt: float = FRAME_TIME) -> None:
         """ Animates buttons """
-        self.button_list.update()
+        self.button_list.update(dt)
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :returns: Areas of buttons which changed, the title is static """
+        return self.button_list.dirty_rects()
 
     def handle(self, event: pygame.event.Event) -> None:
         """ Handles mouse clicks
@@ -136,8 +166,11 @@ class MainMenu(GameState):
 class GameOver(GameState):
     """ Represents the game over screen """
 
-    def __init__(self, score=0):
-        """ Initializes menu with buttons and score"""
+    def __init__(self, score=0, timing: beatline.TimingStats = None):
+        """ Initializes menu with buttons and score
+        :param score: Final score of the session
+        :param timing: optional, timing offsets of the session, shown under the score
+        """
         super().__init__()
 
         self.button_list = ButtonList((WIDTH / 2, 0.6 * HEIGHT), 0.2 * HEIGHT)
@@ -149,29 +182,48 @@ class GameOver(GameState):
                                           action=lambda: Game.switch_to(MainMenu()),
                                           keys=[pygame.K_ESCAPE, pygame.K_BACKSPACE])
 
-        self.font = pygame.font.Font(FONT_PATH, FONT_SIZE)
+        self.assets = Assets.get_instance()
         self.score = score
+        self.timing = timing
 
-    def render(self) -> pygame.Surface:
+    def render(self, screen: pygame.Surface) -> None:
         """ Renders game over message and menu buttons
-        :returns: PyGame surface with the result
+        :param screen: Target surface, already cleared by the caller
         """
-        screen = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
-
-        score_surface = self.font.render(TEXT.SCORE + str(self.score), True, Color.WHITE)
+        score_surface = self.assets.text(TEXT.SCORE + str(self.score), FONT_SIZE, Color.WHITE)
         score_rect = score_surface.get_rect(center=(WIDTH / 2, 0.2 * HEIGHT))
-        text_surface = self.font.render(TEXT.GAME_OVER, True, Color.WHITE)
+        text_surface = self.assets.text(TEXT.GAME_OVER, FONT_SIZE, Color.WHITE)
         text_rect = text_surface.get_rect(center=(WIDTH / 2, 0.1 * HEIGHT))
         screen.blit(text_surface, text_rect)
         screen.blit(score_surface, score_rect)
+        if self.timing is not None:
+            self.render_timing(screen)
 
         self.button_list.render(screen)
 
-        return screen
-
-    def update(self) -> None:
+    def render_timing(self, screen: pygame.Surface) -> None:
+        """ Renders the timing summary and the histogram of early (blue) and late (red) hits
+        :param screen: Target surface
+        """
+        summary_surface = self.assets.text(self.timing.summary(), FONT_SIZE // 2, Color.WHITE)
+        screen.blit(summary_surface, summary_surface.get_rect(center=(WIDTH / 2, 0.29 * HEIGHT)))
+        counts = self.timing.histogram()
+        if not any(counts):
+            return
+        bar_width, max_height = 24, 0.1 * HEIGHT
+        left, bottom = WIDTH / 2 - bar_width * len(counts) / 2, 0.45 * HEIGHT
+        for i, count in enumerate(counts):
+            height = max_height * count / max(counts)
+            color = Color.BLUE if i < len(counts) / 2 else Color.RED
+            pygame.draw.rect(screen, color, (left + i * bar_width, bottom - height, bar_width - 2, height))
+
+    def update(self, dt: float = FRAME_TIME) -> None:
         """ Animates buttons """
-        self.button_list.update()
+        self.button_list.update(dt)
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :returns: Areas of buttons which changed, the score and the message are static """
+        return self.button_list.dirty_rects()
 
     def handle(self, event: pygame.event.Event) -> None:
         """ Handles mouse and keyboard input
@@ -183,15 +235,44 @@ class GameOver(GameState):
 class GameSession(GameState):
     """represents the gameplay screen"""
 
-    def __init__(self):
-        """initialises playing field, player model, abilities, and beatline. Also starts music"""
+    def __init__(self, seed: int = None, clock: beatline.Clock = None, replay: Recording = None,
+                 save_replay: bool = True):
+        """initialises playing field, player model, abilities, and beatline. Also starts music.
+        Key presses are judged at the time.perf_counter() stored in event.timestamp when it was polled, see main
+        :param seed: optional, seed of the tower, random by default
+        :param clock: optional, time source of the beatline, the playback position of the music by default
+        :param replay: optional, recording to play back instead of reading the keyboard
+        :param save_replay: optional, whether the recording is saved to REPLAY_DIR when the session ends
+        """
         super().__init__()
 
-        self.score = 0
-        self.tower = Tower()
-        self.ability_bar = AbilityBar(self.tower.move_sequence)
-        self.ability_bar.copy_abilities(Settings.get_instance().ability_bar)
-        self.beatline = beatline.DrawableLine((WIDTH / 2, HEIGHT * 0.85), WIDTH / 2, MUSIC.BEAT_PATH, 2000)
+        self.replay = replay
+        self.save_replay = save_replay
+        self.replayed_hits = replay.hits() if replay is not None else {}
+        if replay is not None:
+            seed = replay.seed
+            names = replay.abilities
+            MUSIC.set_title(MUSIC.TITLES.index(replay.track))
+        else:
+            names = Settings.get_instance().ability_bar.names()
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        self.recording = Recording(seed, names, MUSIC.TITLE)
+        self.timing = beatline.TimingStats()
+        self.dispatcher = Dispatcher()
+        for action in GAME_ACTIONS:
+            self.dispatcher.on_action(action, lambda event, action=action: self.press(event, action))
+        # other keys spend the beat without an action
+        self.dispatcher.on_other_key(lambda event: self.press(event, ""))
+        self.monitor = PerfMonitor.get_instance()
+        self.monitor.start_session(MUSIC.TITLE)
+
+        self.ability_bar = AbilityBar()
+        self.ability_bar.set_abilities(names)
+        self.tower = Tower(names, seed)
+        self.ability_bar.bind(self.tower.sim.abilities)
+        self.beatline = beatline.DrawableLine((WIDTH / 2, HEIGHT * 0.85), WIDTH / 2, MUSIC.BEAT_PATH, 2000,
+                                                clock if clock is not None else beatline.AudioClock())
         self.dynamic_elements = [self.beatline, self.ability_bar, self.tower]
 
         try:
@@ -201,30 +282,81 @@ class GameSession(GameState):
             print(MUSIC.PLAY_ERROR)
 
     def handle(self, event):
-        """handles user input, checks whether any beats are active"""
-        if event.type == pygame.KEYDOWN:
-            if self.beatline.is_active():
-                self.beatline.deactivate()
-                for elem in self.dynamic_elements:
-                    elem.handle(event)
-                self.score += 1
-
-    def render(self) -> pygame.Surface:
-        """renders the tower, player model and beatline onto the screen"""
-        screen = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
+        """handles user input, routing key presses to actions, see controls.Bindings"""
+        if self.replay is None:
+            self.dispatcher.dispatch(event)
+
+    def press(self, event: pygame.event.Event, action: str) -> None:
+        """ Judges a key press against the nearest beat and performs the action if it hit one
+        :param event: KEYDOWN event, judged at event.timestamp if it has one
+        :param action: Name of the action bound to the key, see controls.GAME_ACTIONS
+        """
+        judged = self.beatline.judge(getattr(event, "timestamp", None))
+        if judged is not None:
+            index, offset = judged
+            self.timing.add(offset)
+            self.act(index, action)
+
+    def act(self, index: int, action: str) -> None:
+        """ Uses up an active beat to perform an action and records it
+        :param index: index of the active beat
+        :param action: Name of the action, see controls.GAME_ACTIONS
+        """
+        self.beatline.use(index)
+        self.tower.act(action)
+        self.recording.add(index, action)
+
+    def render(self, screen: pygame.Surface) -> None:
+        """renders the tower, player model and beatline onto the screen
+        :param screen: Target surface, already cleared by the caller
+        """
         for elem in self.dynamic_elements:
-            elem.render(screen)
-        return screen
+            with self.monitor.measure(type(elem).__name__ + ".render"):
+                elem.render(screen)
 
-    def update(self):
-        """switches to the game over screen if the player is dead"""
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :returns: Areas of the tower, the beatline and the ability bar """
+        return [rect for elem in self.dynamic_elements for rect in elem.dirty_rects()]
+
+    def update(self, dt: float = FRAME_TIME):
+        """switches to the game over screen if the player is dead, plays back the replayed inputs"""
         if not self.tower.is_player_alive():
             pygame.mixer.music.stop()
-            Game.switch_to(GameOver(self.score))
+            self.tower.close()
+            self.finish()
+            Game.switch_to(GameOver(self.tower.sim.score, self.timing if self.replay is None else None))
+            return
+        if self.replay is not None:
+            index = self.beatline.active_index()
+            if index is not None and index in self.replayed_hits:
+                self.act(index, self.replayed_hits[index])
         for elem in self.dynamic_elements:
-            elem.update()
-        if self.beatline.cleanup():
+            with self.monitor.measure(type(elem).__name__ + ".update"):
+                elem.update(dt)
+        for index in self.beatline.cleanup():
             self.tower.move_floor(1)
+            self.recording.add(index)
+
+    def perf_counters(self) -> dict:
+        """ :returns: Tower rows held in memory, beats on the line
+        and how many times the main thread had to wait for a prefetched chunk """
+        return {"rows": len(self.tower.sim.grid), "beats": len(self.beatline),
+                "chunk_waits": self.tower.prefetcher.waits}
+
+    def finish(self) -> None:
+        """ Saves the recording of the session to REPLAY_DIR if asked to, replays are not saved again """
+        self.monitor.end_session()
+        self.recording.score = self.tower.sim.score
+        if self.replay is not None:
+            print(f"Replayed score: {self.recording.score}, recorded: {self.replay.score}")
+            return
+        if not self.save_replay:
+            return
+        try:
+            os.makedirs(REPLAY_DIR, exist_ok=True)
+            self.recording.save(os.path.join(REPLAY_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json"))
+        except OSError as error:
+            print(f"Failed to save the replay: {error}")
 
 
 class MusicSelectionMenu(GameState):
@@ -242,32 +374,39 @@ class MusicSelectionMenu(GameState):
                                           action=lambda: Game.switch_to(MainMenu()),
                                           keys=[pygame.K_ESCAPE, pygame.K_BACKSPACE])
 
-        self.font = pygame.font.Font(FONT_PATH, FONT_SIZE)
+        self.assets = Assets.get_instance()
+        self.drawn_difficulty = TEXT.DIFFICULTY
 
-    def render(self) -> pygame.Surface:
-        """ Renders buttons and text """
-        screen = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
-
-        text_surface = self.font.render(TEXT.SELECT_TRACK_INVITATION, True, Color.WHITE)
+    def render(self, screen: pygame.Surface) -> None:
+        """ Renders buttons and text
+        :param screen: Target surface, already cleared by the caller
+        """
+        text_surface = self.assets.text(TEXT.SELECT_TRACK_INVITATION, FONT_SIZE, Color.WHITE)
         text_rect = text_surface.get_rect(center=(WIDTH / 2, 0.1 * HEIGHT))
         screen.blit(text_surface, text_rect)
-        text_surface = self.font.render(TEXT.DIFFICULTY, True, Color.WHITE)
+        text_surface = self.assets.text(TEXT.DIFFICULTY, FONT_SIZE, Color.WHITE)
         text_rect = text_surface.get_rect(center=(WIDTH / 2, 0.6 * HEIGHT))
         screen.blit(text_surface, text_rect)
 
         self.button_list.render(screen)
 
-        return screen
-
     def handle(self, event: pygame.event.Event) -> None:
         """ Handles mouse and keyboard input
         :param event: PyGame event to be handled
         """
         self.button_list.handle(event)
 
-    def update(self) -> None:
+    def update(self, dt: float = FRAME_TIME) -> None:
         """ Animates buttons """
-        self.button_list.update()
+        self.button_list.update(dt)
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :returns: Areas of buttons which changed and the difficulty line if the track changed """
+        rects = self.button_list.dirty_rects()
+        if self.drawn_difficulty != TEXT.DIFFICULTY:
+            self.drawn_difficulty = TEXT.DIFFICULTY
+            rects.append(pygame.Rect(0, 0.6 * HEIGHT - FONT_SIZE, WIDTH, 2 * FONT_SIZE))
+        return rects
 
 
 class AbilitySelectionMenu(GameState):
@@ -292,60 +431,114 @@ class AbilitySelectionMenu(GameState):
                                            action=lambda: Game.switch_to(MainMenu()),
                                            keys=[pygame.K_ESCAPE, pygame.K_BACKSPACE]))
 
-        self.font = pygame.font.Font(FONT_PATH, FONT_SIZE)
-
-    def render(self) -> pygame.Surface:
-        """ Renders buttons and text """
-        screen = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
+        self.assets = Assets.get_instance()
 
-        text_surface = self.font.render(TEXT.SELECT_ABILITY_INVITATION, True, Color.WHITE)
+    def render(self, screen: pygame.Surface) -> None:
+        """ Renders buttons and text
+        :param screen: Target surface, already cleared by the caller
+        """
+        text_surface = self.assets.text(TEXT.SELECT_ABILITY_INVITATION, FONT_SIZE, Color.WHITE)
         text_rect = text_surface.get_rect(center=(WIDTH * 0.6, 0.1 * HEIGHT))
         screen.blit(text_surface, text_rect)
 
         self.button_list.render(screen)
         self.ability_bar.render(screen)
 
-        return screen
-
     def handle(self, event: pygame.event.Event) -> None:
         """ Handles mouse and keyboard input
         :param event: PyGame event to be handled
         """
         self.button_list.handle(event)
 
-    def update(self) -> None:
+    def update(self, dt: float = FRAME_TIME) -> None:
         """ Animates buttons """
-        self.button_list.update()
+        self.button_list.update(dt)
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :returns: Areas of buttons which changed and the ability bar """
+        return self.button_list.dirty_rects() + self.ability_bar.dirty_rects()
+
+
+def redraw(screen: pygame.Surface, game: Game, rects: list[pygame.Rect]) -> list[pygame.Rect]:
+    """ Renders the game straight onto the screen once per changed area, clipped to it, nothing if there are none.
+    Once the changed areas add up to more than FULL_REDRAW_SHARE of the screen, the whole screen is redrawn instead
+    :param screen: The display surface, its other areas keep the previous frame
+    :param game: Game to render
+    :param rects: Changed areas, see Game.dirty_rects
+    :return: Areas to push to the display
+    """
+    if sum(rect.width * rect.height for rect in rects) > FULL_REDRAW_SHARE * screen.get_width() * screen.get_height():
+        rects = [screen.get_rect()]
+    # fills of areas starting and ending off a 16 pixel column are several times slower
+    rects = [pygame.Rect(rect.left & ~15, rect.top, ((rect.right + 15) & ~15) - (rect.left & ~15), rect.height)
+             .clip(screen.get_rect()) for rect in rects]
+    for rect in rects:
+        screen.set_clip(rect)
+        screen.fill(Color.BLACK)
+        game.render(screen)
+    screen.set_clip(None)
+    return rects
+
+
+def poll_events(deadline: float) -> list[pygame.event.Event]:
+    """ Collects events until the deadline, every event gets the time of the poll which found it as event.timestamp
+    :param deadline: time.perf_counter() value to poll until, polls once if it has passed
+    :return: Events in the order they happened
+    """
+    events = []
+    while True:
+        now = time.perf_counter()
+        for event in pygame.event.get():
+            event.timestamp = now
+            events.append(event)
+        if now >= deadline:
+            return events
+        time.sleep(min(POLL_INTERVAL / 1000, deadline - now))
 
 
-def main():
+def main(start=None):
+    """ Runs the game window
+    :param start: optional, function() -> GameState creating the first state, MainMenu by default
+    """
     pygame.init()
     pygame.font.init()
 
     screen = pygame.display.set_mode((WIDTH, HEIGHT))
 
-    game = Game()
+    game = Game(start)
     clock = pygame.time.Clock()
+    monitor = PerfMonitor.get_instance()
     finished = False
 
+    next_frame = time.perf_counter()
+
     # Main cycle
     while not finished:
-        clock.tick(FPS)
+        # Waits for the next frame polling input, rather than sleeping and finding the events late
+        next_frame = max(next_frame + FRAME_TIME / 1000, time.perf_counter())
+        events = poll_events(next_frame)
+        dt = clock.tick()
+        monitor.begin_frame(dt)
+        Input.get_instance().snapshot()
         # Handles events
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
                 finished = True
-            else:
+            elif not monitor.handle(event):
                 game.handle(event)
 
-        game.update()
-
-        # Renders game
-        screen.blit(game.render(), (0, 0))
-
-        # Updates screen
-        pygame.display.update()
-        screen.fill(Color.BLACK)
+        with monitor.measure("update"):
+            game.update(dt)
+
+        # Renders game and pushes only the changed areas to the display
+        with monitor.measure("render"):
+            rects = redraw(screen, game, game.dirty_rects() + monitor.dirty_rects())
+        monitor.render(screen)
+        if rects:
+            with monitor.measure("flip"):
+                pygame.display.update(rects)
+        monitor.end_frame(game.state)
+    monitor.close()
     pygame.quit()
 
 
@@ -1,16 +1,26 @@
-import os.path
+import math
+import random
 import pygame
-from random import choice
+import threading
+from functools import partial
+from queue import Queue, Empty, Full
 from locals import *
 from chunks import ctype_by_letter
+from simulation import Chunk, ChunkChooser, Simulation, ABILITY_SPECS
+import simulation
 from spritesheet import SpriteSheet
+from perf import SurfaceCounter
 
 """
-Responsible for modeling and rendering of the game field and the player
+Responsible for rendering of the game field and the player.
+The rules themselves live in simulation.py, the classes here draw its state
 
 Classes:
     
     Cell
+    TileSet
+    PreparedChunk
+    ChunkPrefetcher
     Tower
     Player
     PlayerArtist
@@ -20,7 +30,7 @@ Classes:
 
 class Cell:
     """ Stores the cell image and the type.
-    Designed to be created with the Tower.load_chunk() function"""
+    Designed to be shared between all tiles of the same kind, see TileSet"""
 
     def __init__(self, size, ctype, image):
         """
@@ -32,120 +42,180 @@ class Cell:
         self.size = size  # Currently unused, but may be usefull in future
         self.celltype = ctype
         self.image = pygame.transform.scale(image, size)
+        SurfaceCounter.add()
 
     def render(self) -> pygame.Surface:
         """:return: PyGame surface with the cell image"""
         return self.image
 
-    def is_empty(self) -> bool:
-        return self.celltype == 'N'
 
-    def is_walkable(self) -> bool:
-        return self.celltype == 'N' or self.celltype == 'H'
+class TileSet:
+    """ Flyweight cache of cells: one pre-scaled Cell per tile letter, built once per tile size
+    and shared by every row of every tower """
 
+    _spritesheet = None
+    _cache = {}
 
-class Tower:
-    """ Stores and loads from file all cells,  """
-    WIDTH = 13  # the width of the tower in cells
-    HEIGHT = 15  # the height of the tower in cells
-    animtime = 4  # the amount of frames the movement animation takes
-
-    def __init__(self):
-        """ Initializes tower with data from field.txt file """
-        self.spritesheet = SpriteSheet('towersheet.png')
-        self.cells = []
-        self.level = 0  # level of the floor of the tower
-        self.target_level = 0  # level at which the tower should be when the animation is finished
-        self.loaded_level = 0  # level of the highest loaded cell
-        self.progress = 0  # an amount from 0 to animtime, how much the tower has progressed in animation
-        self.load_chunk(os.path.join('resources', 'chunks', '0_0.txt'))
-        self.cell_length = 0.8 * HEIGHT / Tower.HEIGHT
-        self.player = Player((self.cell_length, self.cell_length))
-
-    def move_floor(self, amount=1) -> None:
-        """ Moves tower any amount of cells down
-        :param amount: The amount of cells to raise the level by
+    @staticmethod
+    def get(size: int) -> dict[str, Cell]:
         """
-        self.target_level += amount
-
-    def get_chunk_path(self) -> str:
+        :param size: the length of the cell side in pixels
+        :return: dict mapping chunk letters (see chunks.py) to shared Cell instances
         """
-        Randomly chooses chunk with difficulty based on tower level
-        :return: Chunk file path
+        if size not in TileSet._cache:
+            if TileSet._spritesheet is None:
+                TileSet._spritesheet = SpriteSheet('towersheet.png')
+            TileSet._cache[size] = {letter: Cell((size, size), ctype, TileSet._spritesheet.image_at(rect))
+                                    for letter, (ctype, rect) in ctype_by_letter.items()}
+        return TileSet._cache[size]
+
+
+class PreparedChunk(Chunk):
+    """ Chunk with its cells composited into a pre-rendered strip, ready to be spliced into the tower.
+    A strip holds as many pixels as the per-cell surfaces it replaces, so rendering a chunk takes one blit instead
+    of one per cell at the cost of that memory. Strips live only as long as their chunk is held by the grid
+    or waits in the ChunkPrefetcher, about five megabytes in total """
+
+    def __init__(self, letters: tuple[str, ...], cell_length: float):
         """
-        if self.level <= 40:
-            difficulty = '0'
-        elif self.level <= 120:
-            difficulty = '1'
-        else:
-            difficulty = '2'
-
-        chunkname = choice(os.listdir(os.path.join('resources', 'chunks', difficulty)))
-        return os.path.join('resources', 'chunks', difficulty, chunkname)
-
-    def load_chunk(self, chunk_path='') -> None:
-        """ Loads chunk from a prepared(see chunks.py) file
-        :param chunk_path: optional, use if you want to load a specific chunk by path
+        :param letters: Rows of chunk letters, listed from bottom to top
+        :param cell_length: the length of the cell side on the screen
         """
-        if not chunk_path:
-            chunk_path = self.get_chunk_path()
-        dump = open(chunk_path, 'r').readlines()
-        dump.reverse()
-        newcells = []
-        a = int(0.8 * HEIGHT / Tower.HEIGHT)
-        for n, line in enumerate(dump):
-            newcells.append([])
-            for sym in line.strip():
-                newcells[n].append(
-                    Cell((a, a), ctype_by_letter[sym][0], self.spritesheet.image_at(ctype_by_letter[sym][1])))
-        self.cells = self.cells + newcells
-        self.loaded_level += len(dump)
+        super().__init__(letters)
+        self.strip = PreparedChunk.render_strip(letters, cell_length)
 
     @staticmethod
-    def is_inside(pos: tuple[int, int]) -> bool:
-        """
-        :param pos: (x, y) of a cell
-        :return: True if pos is a valid cell
-        """
-        x, y = pos
-        return 0 <= x <= Tower.WIDTH
+    def render_strip(letters: tuple[str, ...], cell_length: float) -> pygame.Surface:
+        """ Composites all cells of the chunk into a single surface
+        :param letters: Rows of chunk letters, listed from bottom to top
+        :param cell_length: the length of the cell side on the screen
+        :return: Surface with the lowest row at the bottom
+        """
+        tiles = TileSet.get(int(cell_length))
+        height = math.ceil(cell_length * len(letters))
+        strip = pygame.Surface((math.ceil(cell_length * Tower.WIDTH), height))
+        SurfaceCounter.add()
+        for i, row in enumerate(letters):
+            y = int(height - (i + 1) * cell_length)
+            for j, sym in enumerate(row):
+                strip.blit(tiles[sym].render(), (int(j * cell_length), y))
+        return strip
+
+
+class ChunkPrefetcher:
+    """ Runs a chunk source on a worker thread.
+    Ready chunks wait in a bounded queue, so the main thread only has to splice them in.
+    An exception raised by the source ends the worker and is raised again by get """
+
+    def __init__(self, source: ChunkChooser, depth: int):
+        """ Starts the worker thread
+        :param source: Chunk source to run, must not be used by anyone else afterwards
+        :param depth: the amount of chunks prepared in advance
+        """
+        self.source = source
+        self.queue = Queue(maxsize=depth)
+        self.waits = 0  # how many times the main thread had to wait for a chunk
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.work, name="ChunkPrefetcher", daemon=True)
+        self.thread.start()
+
+    def work(self) -> None:
+        """ Worker thread loop, fills the queue until stopped or until the source fails """
+        while not self.stopped.is_set():
+            try:
+                chunk = self.source.get()
+            except Exception as error:
+                # handed over to the main thread, which would otherwise wait for the next chunk forever
+                self.queue.put(error)
+                return
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(chunk, timeout=0.1)
+                    break
+                except Full:
+                    pass
+
+    def get(self) -> PreparedChunk:
+        """ :return: the next prepared chunk, waits for the worker if none is ready
+        :raises Exception: the exception the source raised, once the chunks prepared before it are taken
+        """
+        try:
+            chunk = self.queue.get_nowait()
+        except Empty:
+            self.waits += 1
+            chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def stop(self) -> None:
+        """ Stops the worker thread """
+        self.stopped.set()
 
-    def is_empty(self, pos: tuple[int, int]) -> bool:
-        """
-        :param pos: (x, y) of a cell
-        :return: True if player can stay in the cell
+
+class Tower:
+    """ Renders the grid of a Simulation, animating the floor drops """
+    WIDTH = simulation.WIDTH  # the width of the tower in cells
+    HEIGHT = 15  # the height of the tower in cells
+    PREFETCH_DEPTH = 3  # the amount of chunks prepared in advance by the ChunkPrefetcher
+    DEFAULT_ABILITIES = list(ABILITY_SPECS)[:4]
+    animtime = 4 * 1000 / 30  # the amount of milliseconds the floor animation takes
+
+    def __init__(self, abilities: list[str] = None, seed: int = None,
+                 prefetch_depth: int = PREFETCH_DEPTH):
+        """ Creates the simulation and starts prefetching chunks for it
+        :param abilities: optional, names of the abilities bound to the ability keys, DEFAULT_ABILITIES by default,
+            see simulation.ABILITY_SPECS
+        :param seed: optional, seed of the chunk choice, the same seed builds the same tower
+        :param prefetch_depth: the amount of chunks prepared in advance
         """
-        x, y = pos
-        return self.is_inside(pos) and self.cells[y][x].is_empty()
+        self.cell_length = 0.8 * HEIGHT / Tower.HEIGHT
+        self.size = (int(self.cell_length * Tower.WIDTH), int(self.cell_length * Tower.HEIGHT))
+        if abilities is None:
+            abilities = list(Tower.DEFAULT_ABILITIES)
+        self.sim = Simulation(abilities, chunk_type=partial(PreparedChunk, cell_length=self.cell_length),
+                              rng=random.Random(seed))
+        self.prefetcher = ChunkPrefetcher(self.sim.source, prefetch_depth)
+        self.sim.source = self.prefetcher
+        self.level = 0  # animated level of the floor of the tower
+        self.progress = 0  # an amount from 0 to animtime, how many milliseconds the animation has run for
+        self.player = Player(self.sim.player, (self.cell_length, self.cell_length))
+
+    @property
+    def target_level(self) -> int:
+        """ :return: level at which the tower should be when the animation is finished """
+        return self.sim.level
 
-    def is_walkable(self, pos: tuple[int, int]) -> bool:
+    def move_floor(self, amount=1) -> None:
+        """ Moves tower any amount of cells down
+        :param amount: The amount of cells to raise the level by
         """
-        :param pos: (x, y) of a cell
-        :return: True if player can walk on the cell(if the cell is empty, or if the cell is a hole)
+        self.sim.drop_floor(amount)
+
+    def act(self, action: str) -> None:
+        """ Performs an action on beat and animates the player through its stops
+        :param action: Name of the pressed key, see simulation.Simulation.step
         """
-        x, y = pos
-        return self.is_inside(pos) and self.cells[y][x].is_walkable()
+        for pos in self.sim.step(action):
+            self.player.player_artist.add_to_queue(pos)
 
-    def update(self) -> None:
-        """Unpacks new chunks when the loaded amount gets too small, updates
-        the level of the tower and updates player
+    def close(self) -> None:
+        """ Stops chunk prefetching, the tower can't grow afterwards """
+        self.sim.close()
+
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ Animates the level of the tower and updates player
+        :param dt: the amount of milliseconds since the previous update
         """
-        if self.loaded_level <= self.level + 20:
-            self.load_chunk()
         if self.level != self.target_level:
-            self.level += (self.target_level - self.level) / (self.animtime - self.progress)
-            self.progress += 1
-            if self.progress == self.animtime:
+            time_left = self.animtime - self.progress
+            if dt >= time_left:
+                self.level = self.target_level
                 self.progress = 0
-        self.player.update()
-
-    def handle(self, event: pygame.event.Event) -> None:
-        """Handles events, dropping the tower 1 floor every button press
-        :param event: a pygame.Event to be handled
-        """
-        if event.type == pygame.KEYDOWN:
-            self.move_floor()
-            self.player.handle(self, event)
+            else:
+                self.level += (self.target_level - self.level) * dt / time_left
+                self.progress += dt
+        self.player.update(dt)
 
     @staticmethod
     def calc_center(pos: tuple[int, int]) -> tuple[int, int]:
@@ -158,109 +228,80 @@ class Tower:
 
     def render(self, screen: pygame.Surface) -> None:
         """
-        Renders cells and the player onto a surface
-        :param screen: pygame surface to blit image on
-        """
-        level = int(self.level)
-        surf = pygame.Surface((self.cell_length * self.WIDTH, self.cell_length * self.HEIGHT))
-        for i in range(level - 1, level + Tower.HEIGHT + 1):
-            for j in range(Tower.WIDTH):
-                pos = (Tower.calc_center((i - self.level, j))[0] - self.cell_length / 2,
-                       Tower.calc_center((i - self.level, j))[1] - self.cell_length / 2)
-                if self.cells and len(self.cells) > i and len(self.cells[i]) > j:
-                    surf.blit(self.cells[i][j].render(), pos)
-        self.player.render(surf, self.level)
-        screen.blit(surf, surf.get_rect(center=(WIDTH / 2, 0.4 * HEIGHT)))
-
-    def move_sequence(self, *steps) -> None:
-        """
-        moves the player a sequence of steps
-        :param steps: a list of (dx, dy) of movements
-        """
-        self.player.move_sequence(self, *steps)
+        Renders pre-rendered chunk strips and the player straight onto a surface, clipped to the tower area
+        :param screen: pygame surface to blit image on, already cleared by the caller
+        """
+        rect = self.get_rect()
+        clip = screen.get_clip()
+        screen.set_clip(rect.clip(clip))
+        floor = 0.8 * HEIGHT  # bottom of the row at self.level, measured from the top of the tower
+        for base, chunk in self.sim.grid.chunks:
+            strip = chunk.strip
+            top = floor - (base - self.level) * self.cell_length - strip.get_height()
+            if top < rect.height and top + strip.get_height() > 0:
+                screen.blit(strip, (rect.left, rect.top + int(top)))
+        self.player.render(screen, self.level, rect.topleft)
+        screen.set_clip(clip)
+
+    def get_rect(self) -> pygame.Rect:
+        """ :return: Screen area covered by the tower """
+        rect = pygame.Rect((0, 0), self.size)
+        rect.center = (WIDTH / 2, 0.4 * HEIGHT)
+        return rect
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :return: List of screen areas which change from frame to frame """
+        return [self.get_rect()]
 
     def is_player_alive(self) -> bool:
-        """ :return: True if player is alive """
+        """ :return: True if the player is still above the animated floor """
         return self.player.is_alive(self.level)
 
 
 class Player:
-    """Responsible for player movement, rendering"""
+    """Responsible for player rendering, the position itself is a simulation.Walker"""
 
-    def __init__(self, size: tuple[int, int]):
+    def __init__(self, walker: simulation.Walker, size: tuple[int, int]):
         """
-        Initializes starting position
+        :param walker: Simulated player position
         :param size: the size (width, height) of the player on the screen
         """
-        self.x, self.y = Tower.WIDTH // 2, 3
+        self.walker = walker
         self.size = size
         self.player_artist = PlayerArtist(self)
 
-    @staticmethod
-    def calc_new_pos(tower: Tower, pos: tuple[int, int], step: tuple[int, int]) -> tuple[int, int]:
-        """
-        Calculates movement from a given position in a given tower
-        :param tower: Tower inside which the player is moving
-        :param pos: (x,y) of a cell
-        :param step: (dx, dy) of a single movement
-        :return: (x, y) of the cell after the movement
-        """
-        new_x, new_y = pos[0] + step[0], pos[1] + step[1]
-        if tower.is_walkable((new_x, new_y)):
-            return new_x, new_y
-        return pos
+    @property
+    def x(self) -> int:
+        return self.walker.x
 
-    def move_sequence(self, tower: Tower, *steps) -> None:
-        """
-        moves the player a sequence of steps
-        :param tower: Tower inside which the player is moving
-        :param steps: a list of (dx, dy) of movements
-        """
-        new_pos = (self.x, self.y)
-        for step in steps:
-            new_pos = self.calc_new_pos(tower, new_pos, step)
-            if tower.is_empty(new_pos):
-                self.x, self.y = new_pos
-                self.player_artist.add_to_queue(new_pos)
-
-    def update(self) -> None:
-        """ Updates the player animation via the PlayerArtist class"""
-        self.player_artist.update()
-
-    def handle(self, tower: Tower, event: pygame.event.Event) -> None:
-        """
-        Handles WASD movement
-        :param tower: Tower inside which the player is moving
-        :param event: Event to be handled, should be of KEYDOWN type
+    @property
+    def y(self) -> int:
+        return self.walker.y
+
+    def update(self, dt: float = FRAME_TIME) -> None:
+        """ Updates the player animation via the PlayerArtist class
+        :param dt: the amount of milliseconds since the previous update
         """
-        if event.type != pygame.KEYDOWN:
-            return
-        if event.key == pygame.K_w:
-            self.move_sequence(tower, (0, 1))
-        elif event.key == pygame.K_s:
-            self.move_sequence(tower, (0, -1))
-        elif event.key == pygame.K_a:
-            self.move_sequence(tower, (-1, 0))
-        elif event.key == pygame.K_d:
-            self.move_sequence(tower, (1, 0))
-
-    def render(self, screen: pygame.Surface, level: float) -> None:
+        self.player_artist.update(dt)
+
+    def render(self, screen: pygame.Surface, level: float, offset: tuple[int, int] = (0, 0)) -> None:
         """
         renders self onto a screen
         :param screen: pygame surface to blit image on
         :param level: the level of the tower
+        :param offset: position (x, y) of the top left corner of the tower on the screen
         """
-        self.player_artist.render(screen, level)
+        self.player_artist.render(screen, level, offset)
 
-    def is_alive(self, level: int) -> bool:
+    def is_alive(self, level: float) -> bool:
         """
         :param level: Level of the tower the player is climbing
         :return: True if player is still visible """
-        return self.y >= level
+        return self.walker.is_alive(level)
 
 
 class PlayerArtist:
-    animtime = 4  # the amount of frames the movement animation takes
+    animtime = 4 * 1000 / 30  # the amount of milliseconds a move between two cells takes
 
     def __init__(self, player):
         self.player = player
@@ -273,6 +314,7 @@ class PlayerArtist:
         self.frames = self.spritesheet.images_at([(180, 10, 160, 160), (350, 10, 160, 160)], Color.WHITE)
         for num, frame in enumerate(self.frames):
             self.frames[num] = pygame.transform.scale(frame, (self.celllength, self.celllength))
+        SurfaceCounter.add(len(self.frames))
         self.rect = self.frames[0].get_rect()
         self.frame_number = 0
 
@@ -282,25 +324,43 @@ class PlayerArtist:
     def switch_frame(self):
         self.frame_number = 1 - self.frame_number
 
-    def update(self):
+    def update(self, dt: float = FRAME_TIME):
+        """ Moves the player towards the queued positions, one after another
+        :param dt: the amount of milliseconds since the previous update
+        """
         if self.queue and self.pos == self.queue[0]:
             self.queue.pop(0)
             self.progress = 0
             if not self.queue:
                 self.switch_frame()
 
-        if self.queue:
-            self.pos = (self.pos[0] + (self.queue[0][0] - self.pos[0]) / (self.animtime - self.progress),
-                        self.pos[1] + (self.queue[0][1] - self.pos[1]) / (self.animtime - self.progress))
-            self.progress += 1
+        while self.queue and dt > 0:
+            target = self.queue[0]
+            time_left = self.animtime - self.progress
+            if dt < time_left:
+                self.pos = (self.pos[0] + (target[0] - self.pos[0]) * dt / time_left,
+                            self.pos[1] + (target[1] - self.pos[1]) * dt / time_left)
+                self.progress += dt
+                break
+            # a long frame may finish several moves, the leftover time goes to the next one
+            self.pos = target
+            self.progress = self.animtime
+            dt -= time_left
+            if dt > 0:
+                self.queue.pop(0)
+                self.progress = 0
+                if not self.queue:
+                    self.switch_frame()
 
-    def render(self, screen: pygame.Surface, level) -> None:
+    def render(self, screen: pygame.Surface, level, offset: tuple[int, int] = (0, 0)) -> None:
         """
         renders self onto a screen
         :param screen: pygame surface to blit image on
         :param level: the level of the tower
+        :param offset: position (x, y) of the top left corner of the tower on the screen
         """
-        self.rect.center = Tower.calc_center((self.pos[1] - level, self.pos[0]))
+        x, y = Tower.calc_center((self.pos[1] - level, self.pos[0]))
+        self.rect.center = (x + offset[0], y + offset[1])
         screen.blit(self.frames[self.frame_number], self.rect)
 
 
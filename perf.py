@@ -0,0 +1,204 @@
+import csv
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+import pygame
+from locals import *
+
+"""
+Live performance counters of the main loop: an overlay toggled with F3 and a per-session export.
+
+Set HIGHER_PERF=1 to show the overlay from the start,
+set HIGHER_PERF_EXPORT=csv or HIGHER_PERF_EXPORT=jsonl to write a row per frame of every GameSession to PERF_DIR
+
+Classes:
+
+    SurfaceCounter
+    PerfMonitor
+
+Constants:
+
+    PERF_DIR
+    TOGGLE_KEY
+    OVERLAY_RECT
+    FIELDS
+"""
+
+PERF_DIR = "perf"
+TOGGLE_KEY = pygame.K_F3
+OVERLAY_RECT = pygame.Rect(0, 0, 480, 95)
+# Columns present in every exported row, states may add their own, see GameState.perf_counters
+FIELDS = ["frame", "time_ms", "frame_ms", "update_ms", "render_ms", "flip_ms", "dropped", "surfaces", "state"]
+
+
+class SurfaceCounter:
+    """ Counts surfaces created by the game. The places allocating surfaces report them with add:
+    Assets, SpriteSheet, TileSet cells, PreparedChunk strips, player and ability frames and the overlay """
+
+    count = 0  # surfaces created since the start
+
+    @staticmethod
+    def add(amount: int = 1) -> None:
+        """
+        :param amount: the amount of surfaces just created
+        """
+        SurfaceCounter.count += amount
+
+
+class PerfMonitor:
+    """ Singleton collecting per-frame timings and counters of the main loop """
+    _instance = None
+
+    def __init__(self):
+        """ Reads the HIGHER_PERF and HIGHER_PERF_EXPORT environment variables """
+        PerfMonitor._instance = self
+        self.visible = False
+        self.export = os.environ.get("HIGHER_PERF_EXPORT", "").lower()
+        self.writer = None
+        self.file = None
+        self.frame = {}
+        self.frames = 0
+        self.dropped = 0  # frames missed against the FPS target since the start
+        self.history = deque(maxlen=FPS)  # the last second of frames, shown averaged on the overlay
+        self.start = time.perf_counter()
+        self.surfaces_before = 0
+        self.font = None
+        self.drawn = False  # whether the overlay is on the screen
+        if os.environ.get("HIGHER_PERF", "") not in ("", "0"):
+            self.toggle()
+
+    @staticmethod
+    def get_instance():
+        """ :returns: the only instance of the class PerfMonitor """
+        if PerfMonitor._instance is None:
+            PerfMonitor()
+        return PerfMonitor._instance
+
+    def toggle(self) -> None:
+        """ Shows or hides the overlay """
+        self.visible = not self.visible
+
+    def handle(self, event: pygame.event.Event) -> bool:
+        """ Toggles the overlay on TOGGLE_KEY
+        :param event: PyGame event to be handled
+        :return: True if the event was used up
+        """
+        if event.type == pygame.KEYDOWN and event.key == TOGGLE_KEY:
+            self.toggle()
+            return True
+        return False
+
+    def begin_frame(self, frame_ms: int) -> None:
+        """ Starts collecting a frame
+        :param frame_ms: the amount of milliseconds since the previous frame, see pygame.time.Clock.get_time
+        """
+        self.frames += 1
+        dropped = max(round(frame_ms * FPS / 1000) - 1, 0) if self.frames > 1 else 0
+        self.dropped += dropped
+        self.surfaces_before = SurfaceCounter.count
+        self.frame = {"frame": self.frames, "time_ms": int((time.perf_counter() - self.start) * 1000),
+                      "frame_ms": frame_ms, "dropped": dropped}
+
+    @contextmanager
+    def measure(self, name: str):
+        """ Times the body of the with statement into the current frame
+        :param name: Name of the measured part, stored as <name>_ms
+        """
+        start = time.perf_counter()
+        yield
+        key = name + "_ms"
+        self.frame[key] = self.frame.get(key, 0) + (time.perf_counter() - start) * 1000
+
+    def end_frame(self, state) -> None:
+        """ Finishes collecting a frame and exports it
+        :param state: Current GameState, asked for its own counters
+        """
+        for key, value in self.frame.items():
+            if key.endswith("_ms"):
+                self.frame[key] = round(value, 3)
+        self.frame.setdefault("surfaces", SurfaceCounter.count - self.surfaces_before)
+        self.frame["state"] = type(state).__name__
+        self.frame.update(state.perf_counters())
+        self.history.append(self.frame)
+        if self.writer is not None:
+            self.writer(self.frame)
+
+    def start_session(self, name: str) -> None:
+        """ Opens a new export file if the export is enabled
+        :param name: Name of the session, becomes part of the file name
+        """
+        self.end_session()
+        if self.export not in ("csv", "jsonl"):
+            return
+        os.makedirs(PERF_DIR, exist_ok=True)
+        path = os.path.join(PERF_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.{self.export}")
+        self.file = open(path, "w", newline="")
+        if self.export == "jsonl":
+            self.writer = lambda frame: self.file.write(json.dumps(frame) + "\n")
+        else:
+            writer = None
+
+            def write_csv(frame):
+                nonlocal writer
+                if writer is None:
+                    # the first frame fixes the columns, GameSession counters don't change later on
+                    writer = csv.DictWriter(self.file, FIELDS + [k for k in frame if k not in FIELDS],
+                                            extrasaction="ignore", restval="")
+                    writer.writeheader()
+                writer.writerow(frame)
+            self.writer = write_csv
+
+    def end_session(self) -> None:
+        """ Closes the export file, if there is one """
+        if self.file is not None:
+            self.file.close()
+        self.file = self.writer = None
+
+    def lines(self) -> list[str]:
+        """ :return: Overlay text, averaged over the last second """
+        frames = list(self.history)
+        if not frames:
+            return []
+
+        def mean(key):
+            return sum(frame.get(key, 0) for frame in frames) / len(frames)
+
+        last = frames[-1]
+        lines = [f"frame {mean('frame_ms'):5.1f} ms  max {max(f['frame_ms'] for f in frames)} ms"
+                 f"  target {1000 / FPS:.1f} ms",
+                 f"update {mean('update_ms'):5.2f}  render {mean('render_ms'):5.2f}  flip {mean('flip_ms'):5.2f} ms",
+                 f"dropped {self.dropped}  surfaces/frame {mean('surfaces'):.1f}"]
+        extra = [f"{key} {value}" for key, value in last.items()
+                 if key not in FIELDS and not key.endswith("_ms")]
+        if extra:
+            lines.append("  ".join(extra))
+        return lines
+
+    def dirty_rects(self) -> list[pygame.Rect]:
+        """ :return: the overlay area while it is visible and once more right after it was hidden """
+        if self.visible or self.drawn:
+            return [OVERLAY_RECT.copy()]
+        return []
+
+    def render(self, screen: pygame.Surface) -> None:
+        """ Draws the overlay in the top left corner if it is visible
+        :param screen: the display surface, already holding the frame below the overlay
+        """
+        self.drawn = self.visible
+        if not self.visible:
+            return
+        # the frame's figure is read before the overlay adds its own text, so showing it doesn't change the figure
+        self.frame["surfaces"] = SurfaceCounter.count - self.surfaces_before
+        if self.font is None:
+            self.font = pygame.font.Font(None, 22)
+        screen.fill(Color.BLACK, OVERLAY_RECT)
+        lines = self.lines()
+        for i, line in enumerate(lines):
+            screen.blit(self.font.render(line, True, Color.GREEN), (5, 5 + 20 * i))
+        SurfaceCounter.add(len(lines))
+
+    def close(self) -> None:
+        """ Finishes the export """
+        self.end_session()
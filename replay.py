@@ -0,0 +1,46 @@
+import argparse
+import time
+from simulation import Recording
+
+"""
+Plays back sessions recorded by main.GameSession, see simulation.Recording.
+By default the session is re-driven in real time with rendering and music,
+with --fast the beat log is re-applied headless as fast as the CPU allows
+
+Functions:
+
+    fast_forward(recording) -> None
+    play(recording) -> None
+"""
+
+
+def fast_forward(recording: Recording) -> None:
+    """ Replays a recording headless and reports whether it ended the same way
+    :param recording: Recording to replay
+    """
+    start = time.perf_counter()
+    sim = recording.simulate()
+    elapsed = time.perf_counter() - start
+    print(f"{len(recording.events)} beats in {elapsed * 1000:.1f} ms, "
+          f"score {sim.score} (recorded {recording.score}), level {sim.level}, player at ({sim.player.x}, {sim.player.y})")
+
+
+def play(recording: Recording) -> None:
+    """ Replays a recording in the game window
+    :param recording: Recording to replay
+    """
+    import main  # opens a window, not needed for headless replays
+
+    main.main(start=lambda: main.GameSession(replay=recording))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plays back a recorded session")
+    parser.add_argument("path", help="recording saved by the game, see locals.REPLAY_DIR")
+    parser.add_argument("--fast", action="store_true", help="replay headless, as fast as possible")
+    args = parser.parse_args()
+
+    if args.fast:
+        fast_forward(Recording.load(args.path))
+    else:
+        play(Recording.load(args.path))
@@ -0,0 +1,416 @@
+import json
+import os.path
+import random
+from collections import deque
+from chunks import ctype_by_letter, parse_chunk, ChunkCatalog
+
+"""
+Pure-Python game rules: the tower grid, player movement, ability cooldowns,
+floor drops and the beat schedule. Does not import pygame, so it can be stepped
+headless at thousands of turns per second (balance testing, bots, automated tests)
+
+Classes:
+
+    Chunk
+    Grid
+    ChunkChooser
+    Walker
+    AbilitySpec
+    AbilityState
+    Simulation
+    Recording
+
+Functions:
+
+    row_mask(row, ctypes) -> int
+
+Constants:
+
+    WIDTH
+    LOOKAHEAD
+    START_CHUNK
+    MOVES
+    ABILITY_KEYS
+    ABILITY_SPECS
+"""
+
+WIDTH = 13  # the width of the tower in cells
+LOOKAHEAD = 20  # the amount of rows kept loaded above the floor
+START_CHUNK = os.path.join('resources', 'chunks', '0_0.txt')
+
+# Actions are named after the keys triggering them
+MOVES = {'w': (0, 1), 's': (0, -1), 'a': (-1, 0), 'd': (1, 0)}
+ABILITY_KEYS = ['h', 'j', 'k', 'l']
+
+
+def row_mask(row: str, ctypes: str) -> int:
+    """
+    :param row: Row of chunk letters
+    :param ctypes: Cell types to look for, see chunks.ctype_by_letter
+    :return: Bitmask with bit x set if cell x has one of the given types
+    """
+    bits = 0
+    for x, sym in enumerate(row):
+        if ctype_by_letter[sym][0] in ctypes:
+            bits |= 1 << x
+    return bits
+
+
+class Chunk:
+    """ Chunk letters together with collision bitmasks of its rows """
+
+    def __init__(self, letters: tuple[str, ...]):
+        """
+        :param letters: Rows of chunk letters, listed from bottom to top
+        """
+        self.letters = letters
+        self.walkable = [row_mask(row, 'NH') for row in letters]
+        self.empty = [row_mask(row, 'N') for row in letters]
+
+    def __len__(self) -> int:
+        """ :return: the amount of rows in the chunk """
+        return len(self.letters)
+
+
+class Grid:
+    """ Bounded store of tower rows addressed by absolute row index.
+    Every row is kept as a walkable and an empty bitmask, bit x standing for cell x.
+    Rows are appended on top and evicted from the bottom, so memory stays flat for any run length """
+
+    def __init__(self, keep_below: int = 4):
+        """
+        :param keep_below: the amount of rows kept below the floor when evicting
+        """
+        self.walkable = deque()
+        self.empty = deque()
+        self.chunks = deque()  # pairs (index of the lowest row, chunk) of chunks with any row held
+        self.base = 0  # absolute index of the lowest row held
+        self.keep_below = keep_below
+
+    @property
+    def top(self) -> int:
+        """ :return: absolute index right above the highest row held """
+        return self.base + len(self.walkable)
+
+    def __len__(self) -> int:
+        """ :return: the amount of rows actually held in memory """
+        return len(self.walkable)
+
+    def __contains__(self, y: int) -> bool:
+        """ :return: True if row y is held in the grid """
+        return self.base <= y < self.top
+
+    def extend(self, chunk: Chunk) -> None:
+        """ Appends chunk rows on top of the grid
+        :param chunk: Chunk to append
+        """
+        self.chunks.append((self.top, chunk))
+        self.walkable.extend(chunk.walkable)
+        self.empty.extend(chunk.empty)
+
+    def evict_below(self, level: int) -> None:
+        """ Frees rows which can no longer be seen or stood on
+        :param level: the floor level of the tower
+        """
+        while self.walkable and self.base < level - self.keep_below:
+            self.walkable.popleft()
+            self.empty.popleft()
+            self.base += 1
+        while len(self.chunks) > 1 and self.chunks[1][0] <= self.base:
+            self.chunks.popleft()
+
+    def is_inside(self, pos: tuple[int, int]) -> bool:
+        """
+        :param pos: (x, y) of a cell
+        :return: True if pos is a valid cell which is currently held in memory
+        """
+        x, y = pos
+        return 0 <= x < WIDTH and y in self
+
+    def is_empty(self, pos: tuple[int, int]) -> bool:
+        """
+        :param pos: (x, y) of a cell
+        :return: True if player can stay in the cell
+        """
+        x, y = pos
+        return 0 <= x < WIDTH and y in self and self.empty[y - self.base] >> x & 1 == 1
+
+    def is_walkable(self, pos: tuple[int, int]) -> bool:
+        """
+        :param pos: (x, y) of a cell
+        :return: True if player can walk on the cell(if the cell is empty, or if the cell is a hole)
+        """
+        x, y = pos
+        return 0 <= x < WIDTH and y in self and self.walkable[y - self.base] >> x & 1 == 1
+
+
+class ChunkChooser:
+    """ Randomly chooses chunks from the ChunkCatalog, with difficulty based on the level they will be placed at,
+    see ChunkCatalog.choose_for_level """
+
+    def __init__(self, first_level: int, rng: random.Random = random, chunk_type=Chunk):
+        """
+        :param first_level: the level at which the first chosen chunk will be placed
+        :param rng: Source of randomness
+        :param chunk_type: Function(letters) -> Chunk building chunks from their letters
+        """
+        self.next_level = first_level
+        self.rng = rng
+        self.chunk_type = chunk_type
+
+    def get(self) -> Chunk:
+        """ :return: the next chunk """
+        letters = ChunkCatalog.get_instance().choose_for_level(self.next_level - LOOKAHEAD, self.rng)
+        self.next_level += len(letters)
+        return self.chunk_type(letters)
+
+    def stop(self) -> None:
+        """ Nothing to stop, present for compatibility with background chunk sources """
+        pass
+
+
+class Walker:
+    """ Position of the player and the movement rules """
+
+    def __init__(self, x: int = WIDTH // 2, y: int = 3):
+        """
+        :param x: Starting column
+        :param y: Starting row
+        """
+        self.x, self.y = x, y
+
+    @staticmethod
+    def calc_new_pos(grid: Grid, pos: tuple[int, int], step: tuple[int, int]) -> tuple[int, int]:
+        """
+        Calculates movement from a given position in a given grid
+        :param grid: Grid inside which the player is moving
+        :param pos: (x,y) of a cell
+        :param step: (dx, dy) of a single movement
+        :return: (x, y) of the cell after the movement
+        """
+        new_x, new_y = pos[0] + step[0], pos[1] + step[1]
+        if grid.is_walkable((new_x, new_y)):
+            return new_x, new_y
+        return pos
+
+    def move_sequence(self, grid: Grid, *steps) -> list[tuple[int, int]]:
+        """
+        Moves a sequence of steps: holes can be passed but not stood on, steps into walls are skipped
+        :param grid: Grid inside which the player is moving
+        :param steps: a list of (dx, dy) of movements
+        :return: Positions the player stopped at, in order
+        """
+        stops = []
+        new_pos = (self.x, self.y)
+        for step in steps:
+            new_pos = self.calc_new_pos(grid, new_pos, step)
+            if grid.is_empty(new_pos):
+                self.x, self.y = new_pos
+                stops.append(new_pos)
+        return stops
+
+    def is_alive(self, level: float) -> bool:
+        """
+        :param level: Level of the tower the player is climbing
+        :return: True if player is still above the floor """
+        return self.y >= level
+
+
+class AbilitySpec:
+    """ Describes what an ability does """
+
+    def __init__(self, name: str, steps: tuple[tuple[int, int], ...], cd: int = 5):
+        """
+        :param name: Displayed ability name
+        :param steps: Movement (dx, dy) steps performed on execution
+        :param cd: cooldown of the ability
+        """
+        self.name = name
+        self.steps = steps
+        self.cd = cd
+
+
+class AbilityState:
+    """ Tracks cooldown of an ability """
+
+    def __init__(self, spec: AbilitySpec):
+        """
+        :param spec: Ability description
+        """
+        self.spec = spec
+        self.cd_left = 0
+
+    def is_active(self) -> bool:
+        """ :returns: True if cd is over """
+        return self.cd_left <= 0
+
+
+ABILITY_SPECS = {spec.name: spec for spec in [
+    AbilitySpec("Knight Left-Up", ((-1, 0), (-1, 0), (0, 1))),
+    AbilitySpec("Knight Up-Left", ((0, 1), (0, 1), (-1, 0))),
+    AbilitySpec("Knight Up-Right", ((0, 1), (0, 1), (1, 0))),
+    AbilitySpec("Knight Right-Up", ((1, 0), (1, 0), (0, 1))),
+    AbilitySpec("Rush Up", ((0, 1), (0, 1), (0, 1))),
+    AbilitySpec("Hop", ((0, 2),)),
+]}
+
+
+class Simulation:
+    """ Complete game state advanced one beat at a time """
+
+    def __init__(self, abilities: list[str], beats: list[int] = None, chunk_type=Chunk,
+                 rng: random.Random = None):
+        """ Loads the starting chunk and enough chunks above it
+        :param abilities: Names of the abilities bound to ABILITY_KEYS, see ABILITY_SPECS
+        :param beats: Beat schedule in milliseconds, optional
+        :param chunk_type: Function(letters) -> Chunk building chunks from their letters
+        :param rng: Source of randomness for chunk choice
+        """
+        self.grid = Grid()
+        self.grid.extend(chunk_type(parse_chunk(START_CHUNK)))
+        self.source = ChunkChooser(self.grid.top, rng if rng is not None else random.Random(), chunk_type)
+        self.player = Walker()
+        self.abilities = [AbilityState(ABILITY_SPECS[name]) for name in abilities]
+        self.beats = beats if beats is not None else []
+        self.beat_index = 0  # index of the next beat in the schedule
+        self.level = 0  # level of the floor of the tower
+        self.score = 0
+        self.fill()
+
+    def fill(self) -> None:
+        """ Loads chunks until there are enough rows above the floor and frees the rows below it """
+        while self.grid.top <= self.level + LOOKAHEAD:
+            self.grid.extend(self.source.get())
+        self.grid.evict_below(self.level)
+
+    def drop_floor(self, amount: int = 1) -> None:
+        """ Moves the floor up the tower
+        :param amount: The amount of cells to raise the level by
+        """
+        self.level += amount
+        self.fill()
+
+    def step(self, action: str) -> list[tuple[int, int]]:
+        """ Performs an action on beat: abilities and their cooldowns first, then the floor drop and movement
+        :param action: Name of the pressed key, see MOVES and ABILITY_KEYS. Other keys only drop the floor
+        :return: Positions the player stopped at, in order
+        """
+        stops = []
+        for key, ability in zip(ABILITY_KEYS, self.abilities):
+            if ability.is_active() and action == key:
+                stops += self.player.move_sequence(self.grid, *ability.spec.steps)
+                ability.cd_left = ability.spec.cd
+            ability.cd_left = max(ability.cd_left - 1, 0)
+        self.drop_floor()
+        if action in MOVES:
+            stops += self.player.move_sequence(self.grid, MOVES[action])
+        self.score += 1
+        return stops
+
+    def is_alive(self) -> bool:
+        """ :return: True if player is alive """
+        return self.player.is_alive(self.level)
+
+    def play(self, policy) -> int:
+        """ Plays the whole beat schedule headless, or until the player falls
+        :param policy: Function(simulation) -> action for the next beat, or None to miss it
+        :return: Final score
+        """
+        while self.beat_index < len(self.beats) and self.is_alive():
+            action = policy(self)
+            if action is None:
+                self.drop_floor()
+            else:
+                self.step(action)
+            self.beat_index += 1
+        return self.score
+
+    def replay(self, events: list[tuple[int, str]]) -> int:
+        """ Re-applies a recorded beat log headless, see Recording
+        :param events: Pairs (beat index, key) in the order they happened, key is None for a missed beat
+        :return: Final score
+        """
+        for beat_index, key in events:
+            if key is None:
+                self.drop_floor()
+            else:
+                self.step(key)
+            self.beat_index = beat_index + 1
+        return self.score
+
+    def close(self) -> None:
+        """ Stops the chunk source """
+        self.source.stop()
+
+
+class Recording:
+    """ Everything needed to reproduce a session exactly: the seed, the settings and the beat log.
+    Inputs are keyed by beat index rather than by time, so a replay doesn't depend on frame timing """
+
+    def __init__(self, seed: int, abilities: list[str], track: str,
+                 events: list[tuple[int, str]] = None, score: int = None):
+        """
+        :param seed: Seed of the chunk choice
+        :param abilities: Names of the abilities bound to ABILITY_KEYS
+        :param track: Title of the played track
+        :param events: Pairs (beat index, key) in the order they happened, key is None for a missed beat
+        :param score: Final score, None while the session is running
+        """
+        self.seed = seed
+        self.abilities = abilities
+        self.track = track
+        self.events = events if events is not None else []
+        self.score = score
+
+    def add(self, beat_index: int, key: str = None) -> None:
+        """ Logs a beat
+        :param beat_index: Index of the beat in the beatline file
+        :param key: Name of the accepted key, None if the beat was missed
+        """
+        self.events.append((beat_index, key))
+
+    def hits(self) -> dict[int, str]:
+        """ :return: dict mapping beat indices to the keys accepted on them """
+        return {beat_index: key for beat_index, key in self.events if key is not None}
+
+    def simulate(self) -> Simulation:
+        """ Replays the log headless, as fast as possible
+        :return: Simulation in the state the session ended with
+        """
+        sim = Simulation(self.abilities, rng=random.Random(self.seed))
+        sim.replay(self.events)
+        sim.close()
+        return sim
+
+    def save(self, path: str) -> None:
+        """ Writes the recording as JSON
+        :param path: Path of the file
+        """
+        with open(path, 'w') as f:
+            json.dump({'seed': self.seed, 'abilities': self.abilities, 'track': self.track,
+                       'score': self.score, 'events': self.events}, f)
+
+    @staticmethod
+    def load(path: str):
+        """
+        :param path: Path of a file written by Recording.save
+        :return: Recording read from the file
+        """
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return Recording(data['seed'], data['abilities'], data['track'],
+                         [(beat_index, key) for beat_index, key in data['events']], data['score'])
+
+
+if __name__ == '__main__':
+    """ Measures how fast random bots play headless games """
+    import time
+
+    turns = games = 0
+    start = time.perf_counter()
+    while turns < 20000:
+        sim = Simulation(list(ABILITY_SPECS)[:4], beats=list(range(0, 10 ** 6, 500)))
+        sim.play(lambda s: random.choice('wwwwwadhjkl'))
+        turns += sim.beat_index
+        games += 1
+    print(f"{turns / (time.perf_counter() - start):.0f} turns/s over {games} games")
@@ -1,7 +1,7 @@
 import pygame
 from os import path
-from locals import WIDTH, HEIGHT
 from typing import Union
+from perf import SurfaceCounter
 
 """ 
 Implements SpriteSheet
@@ -11,9 +11,6 @@ Classes:
     SpriteSheet
 """
 
-pygame.init()
-pygame.display.set_mode((WIDTH, HEIGHT))
-
 
 class SpriteSheet:
     
@@ -23,11 +20,23 @@ class SpriteSheet:
         """ Loads the sheet from given file 
         :param filename: Name of the .png sprite sheet """
         try:
-            self.sheet = pygame.image.load(path.join('resources', 'images', filename)).convert()
+            self.sheet = SpriteSheet.convert(pygame.image.load(path.join('resources', 'images', filename)))
+            SurfaceCounter.add()
         except pygame.error as e:
             print(f"Unable to load spritesheet image: {filename}")
             raise SystemExit(e)
 
+    @staticmethod
+    def convert(image: pygame.Surface) -> pygame.Surface:
+        """ Converts image to the display pixel format if the display is already set up
+        :param image: Surface to convert
+        :return: Converted surface, or the same surface when there is no display yet
+        """
+        if pygame.display.get_surface() is None:
+            return image
+        SurfaceCounter.add()
+        return image.convert()
+
     def image_at(self, rectangle: pygame.Rect, colorkey=None) -> pygame.Surface:
         """
         Load a specific image from a specific rectangle.
@@ -36,7 +45,8 @@ class SpriteSheet:
         :return: pygame.Surface containing the requested image
         """
         rect = pygame.Rect(rectangle)
-        image = pygame.Surface(rect.size).convert()
+        image = SpriteSheet.convert(pygame.Surface(rect.size))
+        SurfaceCounter.add()
         image.blit(self.sheet, (0, 0), rect)
         if colorkey is not None:
             if colorkey == -1:
@@ -0,0 +1,269 @@
+import argparse
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+import numpy as np
+
+from chunks import CHUNKS_DIR, DIFFICULTIES, parse_chunk, ChunkCatalog
+from simulation import Chunk, WIDTH, MOVES, ABILITY_SPECS
+
+"""
+Checks that chunks can be climbed with the real movement rules (see simulation.Walker.move_sequence):
+holes can be passed but not stood on, steps into walls are skipped.
+Each chunk is checked in isolation for every set of 4 abilities, ignoring cooldowns and the falling floor:
+the player may start anywhere in the rows right below the chunk and has to get above it.
+Reachability is computed by NumPy frontier expansion, chunks are spread over a process pool
+
+Functions:
+
+    transitions(walkable, empty, steps) -> np.ndarray
+    reachable(moves, starts) -> np.ndarray
+    can_exit(moves, exits) -> np.ndarray
+    shortest_path(moves, starts, exits) -> int
+    padded(chunk) -> tuple[np.ndarray, ...]
+    validate_chunk(chunk_path) -> dict
+    score_chunk(chunk_path) -> dict
+    validate(chunk_paths, workers=None) -> list[dict]
+    score_chunks(chunk_paths, workers=None) -> list[dict]
+    format_report(reports, verbose=False) -> str
+
+Constants:
+
+    PADDING
+    ABILITY_SETS
+    DIFFICULTY_WEIGHTS
+"""
+
+PADDING = 3  # virtual rows on each side of the chunk, enough for the longest ability to cross them
+ABILITY_SETS = list(combinations(ABILITY_SPECS, 4))
+# Contribution of every measured feature to the raw difficulty of a chunk, see score_chunk
+DIFFICULTY_WEIGHTS = {
+    "holes": 1.5,  # share of hole cells
+    "walls": 0.5,  # share of wall cells
+    "unsafe": 1.0,  # share of cells the player can't stand on
+    "turns_per_row": 1.0,  # shortest climb, in beats per chunk row
+    "needs_ability": 0.5,  # 1 if the chunk can't be climbed with WASD only
+    "blocked_sets": 2.0,  # share of ability sets that can't climb the chunk
+}
+
+
+def transitions(walkable: np.ndarray, empty: np.ndarray, steps) -> np.ndarray:
+    """ Applies a move sequence to every cell at once
+    :param walkable: Boolean (height, WIDTH) array, walkable cells of the padded chunk
+    :param empty: Boolean (height, WIDTH) array, empty cells of the padded chunk
+    :param steps: Sequence of (dx, dy) steps
+    :return: Flat array, the flat index of the cell the player stops at for every starting cell
+    """
+    height = walkable.shape[0]
+    cur_y, cur_x = np.indices(walkable.shape)
+    stop_y, stop_x = cur_y.copy(), cur_x.copy()
+    for dx, dy in steps:
+        new_x, new_y = cur_x + dx, cur_y + dy
+        inside = (0 <= new_x) & (new_x < WIDTH) & (0 <= new_y) & (new_y < height)
+        ok = inside & walkable[new_y.clip(0, height - 1), new_x.clip(0, WIDTH - 1)]
+        cur_x, cur_y = np.where(ok, new_x, cur_x), np.where(ok, new_y, cur_y)
+        stops = empty[cur_y, cur_x]
+        stop_x, stop_y = np.where(stops, cur_x, stop_x), np.where(stops, cur_y, stop_y)
+    return (stop_y * WIDTH + stop_x).ravel()
+
+
+def reachable(moves: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """ Expands the frontier of reachable cells until it stops growing
+    :param moves: (actions, cells) array of transitions
+    :param starts: Boolean flat array of starting cells
+    :return: Boolean flat array of reachable cells
+    """
+    seen = starts.copy()
+    frontier = np.flatnonzero(starts)
+    while frontier.size:
+        targets = np.unique(moves[:, frontier])
+        frontier = targets[~seen[targets]]
+        seen[frontier] = True
+    return seen
+
+
+def can_exit(moves: np.ndarray, exits: np.ndarray) -> np.ndarray:
+    """ Finds cells from which some action sequence leads to an exit
+    :param moves: (actions, cells) array of transitions
+    :param exits: Boolean flat array of exit cells
+    :return: Boolean flat array
+    """
+    good = exits.copy()
+    while True:
+        grown = good | good[moves].any(axis=0)
+        if (grown == good).all():
+            return good
+        good = grown
+
+
+def shortest_path(moves: np.ndarray, starts: np.ndarray, exits: np.ndarray) -> int:
+    """ Counts frontier expansions needed to get from the starting cells to an exit
+    :param moves: (actions, cells) array of transitions
+    :param starts: Boolean flat array of starting cells
+    :param exits: Boolean flat array of exit cells
+    :return: The least amount of actions, or -1 if no exit can be reached
+    """
+    seen = starts.copy()
+    frontier = np.flatnonzero(starts)
+    turns = 0
+    while frontier.size:
+        if exits[frontier].any():
+            return turns
+        targets = np.unique(moves[:, frontier])
+        frontier = targets[~seen[targets]]
+        seen[frontier] = True
+        turns += 1
+    return -1
+
+
+def padded(chunk: Chunk) -> tuple[np.ndarray, ...]:
+    """ Surrounds the chunk with PADDING entry rows of holes below and exit rows of empty cells above
+    :param chunk: Chunk with at least one row
+    :return: walkable and empty (height, WIDTH) boolean arrays, flat boolean arrays of
+        entry cells, exit cells and chunk cells, flat indices of the top row of the chunk
+    """
+    size = len(chunk) * WIDTH
+    # Entries are holes, so the player can pass them but never return there, exits are empty
+    below, above = [0] * PADDING, [(1 << WIDTH) - 1] * PADDING
+    bits = 1 << np.arange(WIDTH)
+    walkable = (np.array(above + chunk.walkable + above)[:, None] & bits) != 0
+    empty = (np.array(below + chunk.empty + above)[:, None] & bits) != 0
+    starts = np.zeros(empty.size, dtype=bool)
+    starts[:PADDING * WIDTH] = True
+    exits = np.zeros(empty.size, dtype=bool)
+    exits[PADDING * WIDTH + size:] = True
+    inside = ~starts & ~exits
+    top = np.arange(PADDING * WIDTH + size - WIDTH, PADDING * WIDTH + size)
+    return walkable, empty, starts, exits, inside, top
+
+
+def validate_chunk(chunk_path: str) -> dict:
+    """ Checks a chunk against every ability set
+    :param chunk_path: Path of the chunk file
+    :return: Report: dict with the chunk path, whether the chunk has no rows at all and, for every ability set
+        that can't climb the chunk or leaves dead ends, the unreachable top row cells and the dead end cells (x, y)
+    """
+    chunk = Chunk(parse_chunk(chunk_path))
+    if not len(chunk):
+        return {"chunk": chunk_path, "empty": True, "problems": {}}
+    walkable, empty, starts, exits, inside, top = padded(chunk)
+    flat_empty = empty.ravel()
+
+    basic = [transitions(walkable, empty, [step]) for step in MOVES.values()]
+    ability_moves = {name: transitions(walkable, empty, ABILITY_SPECS[name].steps) for name in ABILITY_SPECS}
+    problems = {}
+    for ability_set in ABILITY_SETS:
+        moves = np.array(basic + [ability_moves[name] for name in ability_set])
+        seen = reachable(moves, starts)
+        good = can_exit(moves, exits)
+        unreachable_exits = [int(i % WIDTH) for i in top if flat_empty[i] and not seen[i]]
+        dead_ends = [(int(i % WIDTH), int(i // WIDTH) - PADDING)
+                     for i in np.flatnonzero(seen & inside & flat_empty & ~good)]
+        if not seen[exits].any() or unreachable_exits or dead_ends:
+            problems[ability_set] = {"climbable": bool(seen[exits].any()),
+                                     "unreachable_exits": unreachable_exits,
+                                     "dead_ends": dead_ends}
+    return {"chunk": chunk_path, "empty": False, "problems": problems}
+
+
+def score_chunk(chunk_path: str) -> dict:
+    """ Measures how hard a chunk is
+    :param chunk_path: Path of the chunk file
+    :return: dict with the measured features (see DIFFICULTY_WEIGHTS) and their weighted sum as "difficulty",
+        None for a chunk without rows
+    """
+    chunk = Chunk(parse_chunk(chunk_path))
+    if not len(chunk):
+        return None
+    walkable, empty, starts, exits, inside, top = padded(chunk)
+    size = len(chunk) * WIDTH
+    basic = [transitions(walkable, empty, [step]) for step in MOVES.values()]
+    ability_moves = {name: transitions(walkable, empty, ABILITY_SPECS[name].steps) for name in ABILITY_SPECS}
+    blocked = sum(1 for ability_set in ABILITY_SETS
+                  if not reachable(np.array(basic + [ability_moves[name] for name in ability_set]), starts)[exits].any())
+    turns = shortest_path(np.array(basic + list(ability_moves.values())), starts, exits)
+    walkable_cells = int(walkable.ravel()[inside].sum())
+    empty_cells = int(empty.ravel()[inside].sum())
+    features = {
+        "holes": (walkable_cells - empty_cells) / size,
+        "walls": 1 - walkable_cells / size,
+        "unsafe": 1 - empty_cells / size,
+        "turns_per_row": (turns if turns >= 0 else 2 * len(chunk)) / len(chunk),
+        "needs_ability": float(not reachable(np.array(basic), starts)[exits].any()),
+        "blocked_sets": blocked / len(ABILITY_SETS),
+    }
+    features["difficulty"] = sum(DIFFICULTY_WEIGHTS[name] * features[name] for name in DIFFICULTY_WEIGHTS)
+    return features
+
+
+def validate(chunk_paths: list[str], workers: int = None) -> list[dict]:
+    """ Validates chunks in parallel
+    :param chunk_paths: Paths of chunk files
+    :param workers: The amount of worker processes, all cores by default
+    :return: Reports in the order of chunk_paths, see validate_chunk
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(validate_chunk, chunk_paths, chunksize=4))
+
+
+def score_chunks(chunk_paths: list[str], workers: int = None) -> list[dict]:
+    """ Scores chunks in parallel
+    :param chunk_paths: Paths of chunk files
+    :param workers: The amount of worker processes, all cores by default
+    :return: Scores in the order of chunk_paths, see score_chunk
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(score_chunk, chunk_paths, chunksize=4))
+
+
+def format_report(reports: list[dict], verbose: bool = False) -> str:
+    """
+    :param reports: Reports produced by validate_chunk
+    :param verbose: List every failing ability set instead of a summary per chunk
+    :return: Human-readable report
+    """
+    lines = []
+    for report in reports:
+        problems = report["problems"]
+        stuck = [ability_set for ability_set, problem in problems.items() if not problem["climbable"]]
+        if report["empty"]:
+            lines.append(f"{report['chunk']}: empty chunk")
+        if not problems:
+            continue
+        lines.append(f"{report['chunk']}: not climbable with {len(stuck)} of {len(ABILITY_SETS)} ability sets, "
+                     f"issues with {len(problems)}")
+        for ability_set, problem in problems.items():
+            if not verbose and problem["climbable"]:
+                continue
+            lines.append(f"    {', '.join(ability_set)}: "
+                         f"{'climbable' if problem['climbable'] else 'NOT CLIMBABLE'}, "
+                         f"unreachable exits x={problem['unreachable_exits']}, dead ends {problem['dead_ends']}")
+    lines.append(f"{len(reports)} chunks checked, {sum(1 for r in reports if r['problems'] or r['empty'])} with issues")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks that chunks can be climbed with every ability set")
+    parser.add_argument("targets", nargs="*", default=DIFFICULTIES,
+                        help="difficulty tiers or chunk files, all tiers by default")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, all cores by default")
+    parser.add_argument("--verbose", action="store_true", help="list ability sets with dead ends too")
+    parser.add_argument("--index", action="store_true",
+                        help="refresh difficulty scores of new and changed chunks instead of validating")
+    args = parser.parse_args()
+
+    if args.index:
+        index = ChunkCatalog().refresh_index(lambda chunk_paths: score_chunks(chunk_paths, args.workers))
+        for name, entry in index.items():
+            print(f"{name:>12}: {entry['score']['difficulty'] if entry['score'] else 'empty'}")
+        raise SystemExit
+
+    paths = []
+    for target in args.targets:
+        if target in DIFFICULTIES:
+            tier_dir = os.path.join(CHUNKS_DIR, target)
+            paths += [os.path.join(tier_dir, name) for name in sorted(os.listdir(tier_dir))]
+        else:
+            paths.append(target)
+    print(format_report(validate(paths, args.workers), args.verbose))